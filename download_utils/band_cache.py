@@ -0,0 +1,132 @@
+import os
+import shutil
+import sqlite3
+import hashlib
+import threading
+import time
+
+## content-addressed store of downloaded Landsat band files, shared across
+## runs and products: keys like 'LC09_L2SP_038038_20240530_20240531_02_T1_SR_B5'
+## map to a sha256 named object under CACHE_DIR/objects/
+CACHE_DIR = '/tmp/data/band_cache/'
+CACHE_BUDGET_GB = 50
+## re-hash cached files before handing them out
+VERIFY_ON_FETCH = True
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bands (
+    key         TEXT PRIMARY KEY,
+    sha256      TEXT NOT NULL,
+    size        INTEGER NOT NULL,
+    last_used   REAL NOT NULL
+)
+"""
+
+## the downloader calls in from several threads
+lock = threading.Lock()
+conn = None
+
+def get_conn():
+    global conn
+    if conn is None:
+        os.makedirs(CACHE_DIR + 'objects/', exist_ok=True)
+        conn = sqlite3.connect(CACHE_DIR + 'index.sqlite', check_same_thread=False)
+        conn.execute(SCHEMA)
+        conn.commit()
+    return conn
+
+def object_fp(sha256: str):
+    return CACHE_DIR + 'objects/' + sha256 + '.TIF'
+
+def file_sha256(fp: str):
+    h = hashlib.sha256()
+    with open(fp, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def link_or_copy(src_fp: str, dst_fp: str):
+    """
+    hard links `src_fp` to `dst_fp` when both are on the same filesystem, so
+    deleting the working copy after use leaves the cached object intact
+    """
+    if os.path.exists(dst_fp):
+        os.remove(dst_fp)
+    try:
+        os.link(src_fp, dst_fp)
+    except OSError:
+        shutil.copyfile(src_fp, dst_fp)
+
+def fetch(key: str, dst_fp: str):
+    """
+    places the cached band `key` at `dst_fp`
+    returns False on a miss, or if the cached object fails its size or
+    checksum check (the bad entry is dropped)
+    """
+    with lock:
+        row = get_conn().execute("SELECT sha256, size FROM bands WHERE key = ?", (key,)).fetchone()
+    if row is None:
+        return False
+    sha256, size = row
+    fp = object_fp(sha256)
+    valid = os.path.isfile(fp) and os.path.getsize(fp) == size
+    if valid and VERIFY_ON_FETCH:
+        valid = file_sha256(fp) == sha256
+    with lock:
+        if not valid:
+            get_conn().execute("DELETE FROM bands WHERE key = ?", (key,))
+            get_conn().commit()
+            remove_unreferenced(sha256)
+            return False
+        get_conn().execute("UPDATE bands SET last_used = ? WHERE key = ?", (time.time(), key))
+        get_conn().commit()
+    link_or_copy(fp, dst_fp)
+    return True
+
+def store(key: str, src_fp: str):
+    """
+    adds the file at `src_fp` to the cache under `key`, then evicts least
+    recently used bands until the cache fits in CACHE_BUDGET_GB
+    """
+    sha256 = file_sha256(src_fp)
+    size = os.path.getsize(src_fp)
+    fp = object_fp(sha256)
+    with lock:
+        db = get_conn()
+        if not os.path.isfile(fp):
+            link_or_copy(src_fp, fp)
+        db.execute("INSERT OR REPLACE INTO bands VALUES (?, ?, ?, ?)",
+                   (key, sha256, size, time.time()))
+        db.commit()
+        evict(CACHE_BUDGET_GB * 1024 ** 3)
+
+def remove_unreferenced(sha256: str):
+    """
+    deletes the object for `sha256` if no key points at it anymore
+    caller holds `lock`
+    """
+    if get_conn().execute("SELECT 1 FROM bands WHERE sha256 = ?", (sha256,)).fetchone() is None:
+        if os.path.isfile(object_fp(sha256)):
+            os.remove(object_fp(sha256))
+
+def evict(budget_bytes: int):
+    """
+    drops least recently used keys until the stored objects fit in
+    `budget_bytes`
+    caller holds `lock`
+    """
+    ## size each object once, identical content under two keys is stored once
+    (total,) = get_conn().execute(
+        "SELECT COALESCE(SUM(size), 0) FROM (SELECT DISTINCT sha256, size FROM bands)").fetchone()
+    if total <= budget_bytes:
+        return
+    rows = get_conn().execute("SELECT key, sha256, size FROM bands ORDER BY last_used").fetchall()
+    for key, sha256, size in rows:
+        if total <= budget_bytes:
+            break
+        get_conn().execute("DELETE FROM bands WHERE key = ?", (key,))
+        if get_conn().execute("SELECT 1 FROM bands WHERE sha256 = ?", (sha256,)).fetchone() is None:
+            total -= size
+            if os.path.isfile(object_fp(sha256)):
+                os.remove(object_fp(sha256))
+    get_conn().commit()
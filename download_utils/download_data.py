@@ -16,6 +16,8 @@ import warnings
 warnings.filterwarnings("ignore")
 from tqdm import tqdm
 
+from download_utils import poll_preparing_downloads
+
 USERNAME = "ozanbayiz"
 SERVICE_URL = "https://m2m.cr.usgs.gov/api/api/json/stable/"
 
@@ -211,39 +213,12 @@ def main():
         #print(f"Get download url: {result['url']}\n" )
         runDownload(threads, result['url'])
         
-    preparingDownloadCount = len(download_request_results['preparingDownloads'])
-    preparingDownloadIds = []
-    if preparingDownloadCount > 0:
-        for result in download_request_results['preparingDownloads']:  
-            preparingDownloadIds.append(result['downloadId'])
-        download_ret_payload = {"label" : label}                
-        # Retrieve download URLs
+    ### poll for downloads that are still being prepared
+    preparingDownloadIds = [result['downloadId'] for result in download_request_results['preparingDownloads']]
+    if preparingDownloadIds:
         print("Retrieving download urls...\n")
-        download_retrieve_results = sendRequest(SERVICE_URL + "download-retrieve", download_ret_payload, apiKey, False)
-        if download_retrieve_results != False:
-            print(f"    Retrieved: \n" )
-            for result in download_retrieve_results['available']:
-                if result['downloadId'] in preparingDownloadIds:
-                    preparingDownloadIds.remove(result['downloadId'])
-                    runDownload(threads, result['url'])
-                    print(f"       {result['url']}\n" )
-            for result in download_retrieve_results['requested']:   
-                if result['downloadId'] in preparingDownloadIds:
-                    preparingDownloadIds.remove(result['downloadId'])
-                    runDownload(threads, result['url'])
-                    print(f"       {result['url']}\n" )
-        
-        # Didn't get all download URLs, retrieve again after 30 seconds
-        while len(preparingDownloadIds) > 0: 
-            print(f"{len(preparingDownloadIds)} downloads are not available yet. Waiting for 30s to retrieve again\n")
-            time.sleep(30)
-            download_retrieve_results = sendRequest(SERVICE_URL + "download-retrieve", download_ret_payload, apiKey, False)
-            if download_retrieve_results != False:
-                for result in download_retrieve_results['available']:                            
-                    if result['downloadId'] in preparingDownloadIds:
-                        preparingDownloadIds.remove(result['downloadId'])
-                        #print(f"    Get download url: {result['url']}\n" )
-                        runDownload(threads, result['url'])
+        poll_preparing_downloads(apiKey, label, preparingDownloadIds,
+                                 lambda url: runDownload(threads, url))
     
     ### initiate download
     print("\nDownloading files...")
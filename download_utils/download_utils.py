@@ -6,6 +6,7 @@ import sys
 import time
 import re
 import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import datetime
 import os
 import os.path
@@ -15,6 +16,9 @@ from dateutil.relativedelta import relativedelta
 import warnings
 warnings.filterwarnings("ignore")
 from tqdm import tqdm
+from requests.adapters import HTTPAdapter
+
+import band_cache
 
 USERNAME = "ozanbayiz"
 SERVICE_URL = "https://m2m.cr.usgs.gov/api/api/json/stable/"
@@ -29,7 +33,28 @@ DATASET_NAME = 'landsat_ot_c2_l2'
 FILE_GROUP_IDS = {"ls_c2l2_sr_band"}
 
 MAX_THREADS = 10 #
-sema = threading.Semaphore(value=MAX_THREADS)
+## look bands up in band_cache before requesting them from M2M
+USE_BAND_CACHE = True
+CHUNK_SIZE = 1024 * 1024
+MAX_RETRIES = 8
+BACKOFF_BASE = 2 # seconds, doubled after every failed attempt
+BACKOFF_MAX = 120
+TIMEOUT = 60 # seconds without data before a connection is considered dropped
+## download-retrieve polling: the interval starts at POLL_MIN_INTERVAL, grows
+## by POLL_BACKOFF while nothing new is ready and resets when something is
+POLL_MIN_INTERVAL = 5
+POLL_MAX_INTERVAL = 60
+POLL_BACKOFF = 1.5
+POLL_DEADLINE = 2 * 60 * 60 # seconds before giving up on preparing downloads
+
+## one pooled session shared by every download thread
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_connections=MAX_THREADS, pool_maxsize=MAX_THREADS))
+executor = ThreadPoolExecutor(max_workers=MAX_THREADS)
+
+## aggregate throughput across all download threads
+stats_lock = threading.Lock()
+stats = {'bytes': 0, 'files': 0, 'start': None}
 
 #taken directly from M2M example script
 def sendRequest(url, data, apiKey = None, exitIfNoResponse = True):
@@ -80,44 +105,183 @@ def sendRequest(url, data, apiKey = None, exitIfNoResponse = True):
     response.close()
     return output['data']
     
-def runDownload(threads, url):
+def runDownload(futures, url, on_ready=None):
     """
-    runs downloadFile function on new thread
+    queues downloadFile(url) on the shared download pool
+    if given, on_ready(band_fp) is called as soon as the file is in place
     """
-    thread = threading.Thread(target=downloadFile, args=(url,))
-    threads.append(thread)
-    thread.start()
-    
-def downloadFile(url):
-    sema.acquire()
-    try:
-        response = requests.get(url, stream=True)
-        disposition = response.headers['content-disposition']
-        filename = re.findall("filename=(.+)", disposition)[0].strip("\"")
-        folder = filename[-9:-4] + f"_{YEAR}/"
-        if not os.path.isfile(DATA_DIR+folder+filename):
-            open(os.path.join(DATA_DIR + folder, filename), 'wb').write(response.content)
-        sema.release()
-    except FileExistsError:
-        sema.release()
-    except Exception as e:
-        print(f"\nFailed to download from {url}. Will try to re-download.")
-        sema.release()
-        runDownload(threads, url)
+    with stats_lock:
+        if stats['start'] is None:
+            stats['start'] = time.perf_counter()
+    futures.append(executor.submit(downloadFile, url, on_ready))
+
+def get_filename(response):
+    disposition = response.headers['content-disposition']
+    return re.findall("filename=(.+)", disposition)[0].strip("\"")
+
+def band_fp(filename):
+    """
+    'LC09_L2SP_038038_20240530_20240531_02_T1_SR_B5.TIF'
+     -> <DATA_DIR>/SR_B5_<YEAR>/LC09_L2SP_038038_20240530_20240531_02_T1_SR_B5.TIF
+    """
+    folder = filename[-9:-4] + f"_{YEAR}/"
+    return os.path.join(DATA_DIR + folder, filename)
+
+def downloadFile(url, on_ready=None):
+    """
+    streams `url` to <DATA_DIR>/<band>_<YEAR>/<filename>, then calls
+    on_ready(<that filename>) if given
+    the body is written in CHUNK_SIZE pieces to a `.part` file that is renamed
+    once complete; after a dropped connection the download resumes from the
+    end of the `.part` file with an HTTP Range request, retrying with
+    exponential backoff up to MAX_RETRIES times before raising
+    """
+    ## the filename is only known from the first response, retries go
+    ## straight to a Range request for the rest of the `.part` file
+    out_fp = part_fp = None
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            offset = os.path.getsize(part_fp) if part_fp and os.path.isfile(part_fp) else 0
+            response = session.get(url, stream=True, timeout=TIMEOUT,
+                                   headers={'Range': f'bytes={offset}-'} if offset else None)
+            try:
+                response.raise_for_status()
+                if out_fp is None:
+                    filename = get_filename(response)
+                    out_fp = band_fp(filename)
+                    if os.path.isfile(out_fp):
+                        break
+                    part_fp = out_fp + '.part'
+                    ## resume a `.part` file left by an earlier run
+                    if os.path.isfile(part_fp) and os.path.getsize(part_fp) > 0:
+                        offset = os.path.getsize(part_fp)
+                        response.close()
+                        response = session.get(url, stream=True, timeout=TIMEOUT,
+                                               headers={'Range': f'bytes={offset}-'})
+                        response.raise_for_status()
+                ## server ignored the range, start over
+                if offset and response.status_code != 206:
+                    offset = 0
+                expected = response.headers.get('content-length')
+                expected = offset + int(expected) if expected is not None else None
+                with open(part_fp, 'ab' if offset else 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                        f.write(chunk)
+                        with stats_lock:
+                            stats['bytes'] += len(chunk)
+            finally:
+                response.close()
+            if expected is not None and os.path.getsize(part_fp) != expected:
+                raise IOError(f"incomplete download of {filename}")
+            os.replace(part_fp, out_fp)
+            if USE_BAND_CACHE:
+                band_cache.store(filename[:-4], out_fp)
+            with stats_lock:
+                stats['files'] += 1
+            break
+        except Exception as e:
+            if attempt == MAX_RETRIES:
+                raise
+            delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)
+            print(f"\nFailed to download from {url} ({e}). Retrying in {delay}s.")
+            time.sleep(delay)
+    if on_ready is not None:
+        on_ready(out_fp)
+    return out_fp
+
+def wait_for_downloads(futures):
+    """
+    waits for every queued download, then prints aggregate throughput and
+    any downloads that failed after all retries
+    """
+    failed = []
+    for future in tqdm(as_completed(futures), total=len(futures)):
+        try:
+            future.result()
+        except Exception as e:
+            failed.append(e)
+    with stats_lock:
+        elapsed = time.perf_counter() - stats['start'] if stats['start'] else 0
+        mb = stats['bytes'] / 1024 / 1024
+        print(f"Downloaded {stats['files']} files, {mb:.1f} MB"
+              + (f" at {mb / elapsed:.1f} MB/s" if elapsed > 0 else ""))
+    for e in failed:
+        print(f"  download failed: {e}")
+    return failed
         
+def poll_preparing_downloads(apiKey, label, preparing_ids, start_download, deadline=POLL_DEADLINE):
+    """
+    polls download-retrieve until every id in `preparing_ids` has a url,
+    calling start_download(url) the moment each one appears; downloads that
+    were already available keep running on the download pool meanwhile
+    input:  apiKey          str
+            label           str         label the downloads were requested with
+            preparing_ids   list        downloadIds still being prepared
+            start_download  callable    e.g. lambda url: runDownload(futures, url)
+            deadline        float       seconds before giving up
+    output: missing         list        downloadIds that never became available
+    """
+    pending = set(preparing_ids)
+    interval = POLL_MIN_INTERVAL
+    give_up = time.monotonic() + deadline
+    download_ret_payload = {"label" : label}
+    while pending:
+        download_retrieve_results = sendRequest(SERVICE_URL + "download-retrieve", download_ret_payload, apiKey, False)
+        started = 0
+        if download_retrieve_results != False:
+            for result in download_retrieve_results['available'] + download_retrieve_results['requested']:
+                if result['downloadId'] in pending and result.get('url'):
+                    pending.remove(result['downloadId'])
+                    start_download(result['url'])
+                    started += 1
+        remaining = give_up - time.monotonic()
+        if not pending or remaining <= 0:
+            break
+        interval = POLL_MIN_INTERVAL if started else min(POLL_MAX_INTERVAL, interval * POLL_BACKOFF)
+        print(f"{len(pending)} downloads are not available yet. Retrying in {interval:.0f}s")
+        time.sleep(min(interval, remaining))
+    if pending:
+        print(f"\n{len(pending)} downloads never became available within {deadline}s:")
+        for download_id in sorted(pending):
+            print(f"  - {download_id}")
+    return sorted(pending)
+
 def get_env_data_as_dict(path: str) -> dict:
     with open(path, 'r') as f:
        return dict(tuple(line.replace('\n', '').split('=')) for line
                 in f.readlines() if not line.startswith('#'))
 
-def download_raw_data(data_dir, band_names, year):
+def download_raw_data(data_dir, band_names, year, start_date=None, end_date=None, skip_products=None, on_band_ready=None):
+    """
+    downloads `band_names` for one scene per WRS-2 path/row into
+    <data_dir>/<band>_<year>/
+    input:  data_dir        str
+            band_names      set     e.g. {'SR_B5', 'SR_B7'}
+            year            int     defaults the acquisition window to
+                                    April 15 - May 15 of `year`
+            start_date      str     overrides the start of the window
+            end_date        str     overrides the end of the window
+            skip_products   dict    path/row -> product id; path/rows whose
+                                    selected product is already listed here
+                                    are not downloaded again
+            on_band_ready   callable    called with each band's filename as
+                                        soon as it is in place, cached or
+                                        downloaded, so work can start before
+                                        every download finishes
+    output: products        dict    path/row -> product id selected for
+                                    every path/row, downloaded or skipped
+    """
     global DATA_DIR
     DATA_DIR = data_dir
     global YEAR
     YEAR = year
     BAND_NAMES = band_names
-    start_date = str(datetime.datetime(year, 4, 15))
-    end_date = str(datetime.datetime(year, 5, 15))
+    filter_year = start_date is None and end_date is None
+    if start_date is None:
+        start_date = str(datetime.datetime(year, 4, 15))
+    if end_date is None:
+        end_date = str(datetime.datetime(year, 5, 15))
+    skip_products = skip_products or {}
     
     label = datetime.datetime.now().strftime("%Y%m%d_%H%M%S") # Customized label using date time
     ### log in to get API Key
@@ -150,7 +314,7 @@ def download_raw_data(data_dir, band_names, year):
                               if result['options']['bulk']], 
                              columns=['date', 'path/row', idField])
     entity_df_grouped = (entity_df
-        .sort_values(by='date')
+        .sort_values(by='date', ascending=False)
         .groupby('path/row')
         .agg(lambda sd: sd.iloc[0]))
     entityIds = list(entity_df_grouped[idField]) 
@@ -172,7 +336,7 @@ def download_raw_data(data_dir, band_names, year):
     ### Select products
     print("Selecting band files ...", end=" ")
     downloads = []
-    threads = []
+    futures = []
     for product in products:  
         if product["secondaryDownloads"] is not None and len(product["secondaryDownloads"]) > 0:
             for secondaryDownload in product["secondaryDownloads"]:
@@ -183,14 +347,35 @@ def download_raw_data(data_dir, band_names, year):
     ### get entityIds of most recent download for each path/row                            
     downloads_df = pd.DataFrame(downloads)
     downloads_df[['path/row', 'date', 'band']] = downloads_df['entityId'].str.extract(r".{15}(\d{6}).{10}(\d{8}).{11}(\d)", expand=True)
+    downloads_df['product_id'] = downloads_df['entityId'].str.extract(r"(L\w\d{2}_L2SP_\d{6}_\d{8}_\d{8}_\d{2}_\w{2})", expand=False)
     downloads_df['year'] = downloads_df['date'].str[:4].astype(int)
-    downloads_df = downloads_df[downloads_df['year'] == year]
+    if filter_year:
+        downloads_df = downloads_df[downloads_df['year'] == year]
     grouped_downloads_df = (downloads_df
-                            .sort_values('date')
                             .groupby(by=['path/row', 'band'])
                             .agg(lambda sd: sd.iloc[0])
                             .drop(columns=['date']))
-    downloads_filtered = grouped_downloads_df.to_dict('records')
+    ### skip path/rows whose selected product is unchanged
+    path_rows = grouped_downloads_df.index.get_level_values('path/row')
+    products = dict(zip(path_rows, grouped_downloads_df['product_id']))
+    changed = [skip_products.get(path_row) != product_id
+               for path_row, product_id in zip(path_rows, grouped_downloads_df['product_id'])]
+    grouped_downloads_df = grouped_downloads_df[changed]
+    print(f"{len(products) - path_rows[changed].nunique()} of {len(products)} path/rows unchanged, skipping")
+    ### serve bands already in the local cache without a network request
+    if USE_BAND_CACHE:
+        filenames = [f"{product_id}_SR_B{band}.TIF" for product_id, band
+                     in zip(grouped_downloads_df['product_id'], grouped_downloads_df.index.get_level_values('band'))]
+        cached = [band_cache.fetch(filename[:-4], band_fp(filename)) for filename in filenames]
+        grouped_downloads_df = grouped_downloads_df[[not hit for hit in cached]]
+        print(f"{sum(cached)} band files served from cache")
+        if on_band_ready is not None:
+            for filename, hit in zip(filenames, cached):
+                if hit:
+                    on_band_ready(band_fp(filename))
+    if len(grouped_downloads_df) == 0:
+        return products
+    downloads_filtered = grouped_downloads_df.drop(columns=['product_id']).to_dict('records')
     download_req2_payload = {
         "downloads": downloads_filtered,
         "label": label
@@ -205,43 +390,16 @@ def download_raw_data(data_dir, band_names, year):
     ### attempt the download URLs
     for result in download_request_results['availableDownloads']:       
         #print(f"Get download url: {result['url']}\n" )
-        runDownload(threads, result['url'])
+        runDownload(futures, result['url'], on_band_ready)
         
-    preparingDownloadCount = len(download_request_results['preparingDownloads'])
-    preparingDownloadIds = []
-    if preparingDownloadCount > 0:
-        for result in download_request_results['preparingDownloads']:  
-            preparingDownloadIds.append(result['downloadId'])
-        download_ret_payload = {"label" : label}                
-        # Retrieve download URLs
+    ### poll for downloads that are still being prepared
+    preparingDownloadIds = [result['downloadId'] for result in download_request_results['preparingDownloads']]
+    if preparingDownloadIds:
         print("Retrieving download urls ...\n")
-        download_retrieve_results = sendRequest(SERVICE_URL + "download-retrieve", download_ret_payload, apiKey, False)
-        if download_retrieve_results != False:
-            print(f"    Retrieved: \n" )
-            for result in download_retrieve_results['available']:
-                if result['downloadId'] in preparingDownloadIds:
-                    preparingDownloadIds.remove(result['downloadId'])
-                    runDownload(threads, result['url'])
-                    print(f"       {result['url']}\n" )
-            for result in download_retrieve_results['requested']:   
-                if result['downloadId'] in preparingDownloadIds:
-                    preparingDownloadIds.remove(result['downloadId'])
-                    runDownload(threads, result['url'])
-                    print(f"       {result['url']}\n" )
-        
-        # Didn't get all download URLs, retrieve again after 30 seconds
-        while len(preparingDownloadIds) > 0: 
-            print(f"{len(preparingDownloadIds)} downloads are not available yet. Waiting for 30s to retrieve again\n")
-            time.sleep(30)
-            download_retrieve_results = sendRequest(SERVICE_URL + "download-retrieve", download_ret_payload, apiKey, False)
-            if download_retrieve_results != False:
-                for result in download_retrieve_results['available']:                            
-                    if result['downloadId'] in preparingDownloadIds:
-                        preparingDownloadIds.remove(result['downloadId'])
-                        #print(f"    Get download url: {result['url']}\n" )
-                        runDownload(threads, result['url'])
+        poll_preparing_downloads(apiKey, label, preparingDownloadIds,
+                                 lambda url: runDownload(futures, url, on_band_ready))
     
     ### initiate download
     print("\nDownloading files...")
-    for thread in tqdm(threads):
-        thread.join()
\ No newline at end of file
+    wait_for_downloads(futures)
+    return products
@@ -0,0 +1,126 @@
+print("\nimporting libraries ...", end=" ")
+import os
+import sys
+import glob
+import time
+from datetime import datetime
+
+os.environ['PROJ_LIB'] =  '/srv/starter_content/_User-Persistent-Storage_/wired-utility/share/proj/'
+
+import warnings
+warnings.filterwarnings("ignore")
+
+import multiprocessing as mp
+
+from download_utils import download_raw_data
+from raster_utils import write_mosaic
+from scene_pool import run_scenes, run_pipeline, report_failures
+from spectral_indices import INDICES, required_bands, band_filename, write_indices
+
+print("Done\n")
+DELETE_RAW_DATA = True
+## write the final mosaics as cloud-optimized GeoTIFFs with overviews
+COG_OUTPUT = True
+## start computing each scene as soon as its bands have downloaded,
+## instead of waiting for every download to finish
+PIPELINE = True
+## indices to compute, see spectral_indices.INDICES
+INDEX_NAMES = ['NBR', 'NDVI', 'NDMI']
+
+MAX_PROCS = mp.cpu_count()
+## GDAL block cache per worker process, in MB
+GDAL_CACHE_MB = 256
+
+DATA_DIR = '/tmp/data/'
+## matches the '<band>_<year>/' folders download_raw_data writes to
+BAND_DIR = DATA_DIR + '{0}_{1}/'
+REPROJ_DIR = DATA_DIR + '{0}_RP_{1}/'
+MOSAICS_DIR = DATA_DIR + '{0}_mosaics/'
+
+REPROJ_SRS = 'EPSG:5070'
+
+def make_dirs(dirs):
+    for d in dirs:
+        if not os.path.exists(d):
+            try:
+                os.makedirs(d)
+                print(f"Directory '{d}' created successfully.")
+            except OSError as e:
+                print(f"Error creating directory '{d}': {e}")
+        else:
+            print(f"Directory '{d}' already exists.")
+
+def write_scene_indices(filename_stem: str, year: int, index_names=INDEX_NAMES, delete_raw_data=DELETE_RAW_DATA):
+    """
+    input:
+     - filename_stem: str
+         something like 'LC09_L2SP_038038_20240530_20240531_02_T1_SR_'
+    Opens every band in `required_bands(index_names)` once, e.g.:
+     - /tmp/data/SR_B5_<year>/<filename_stem>B5.TIF
+     Writes one reprojected raster per index, e.g.:
+     - /tmp/data/NBR_RP_<year>/<filename_stem>NBR.TIF
+    """
+    band_fps = {band: BAND_DIR.format(band, year) + band_filename(filename_stem, band)
+                for band in required_bands(index_names)}
+    out_fps = {name: REPROJ_DIR.format(name, year) + filename_stem + name + '.TIF'
+               for name in index_names}
+    write_indices(band_fps, out_fps, dst_srs=REPROJ_SRS)
+    if delete_raw_data:
+        for band_fp in band_fps.values():
+            os.remove(band_fp)
+
+def get_index_mosaics_for_year(year: int, index_names=INDEX_NAMES):
+    """
+    downloads the bands needed for `index_names` once, computes every index
+    in a single pass per scene and mosaics each index to
+    /tmp/data/<index>_mosaics/<year>.TIF
+    """
+    bands = required_bands(index_names)
+    band_dirs = [BAND_DIR.format(band, year) for band in bands]
+    reproj_dirs = [REPROJ_DIR.format(name, year) for name in index_names]
+    make_dirs(band_dirs + reproj_dirs)
+
+    ## download raw band data, each band exactly once
+    if PIPELINE:
+        print(f"\nDownloading, computing {', '.join(index_names)} and reprojecting...")
+        download = lambda on_band_ready: download_raw_data(
+            DATA_DIR, set(bands), year, on_band_ready=on_band_ready)
+        _, failures = run_pipeline(download, write_scene_indices, bands, year, index_names,
+                                   max_workers=MAX_PROCS, gdal_cache_mb=GDAL_CACHE_MB)
+    else:
+        download_raw_data(DATA_DIR, set(bands), year)
+
+        ## compute indices and reproject
+        print(f"\nComputing {', '.join(index_names)} and reprojecting...")
+        filename_stems = [filename[:-6] for filename in os.listdir(band_dirs[0])]
+        failures = run_scenes(write_scene_indices, filename_stems, year, index_names,
+                              max_workers=MAX_PROCS, gdal_cache_mb=GDAL_CACHE_MB)
+    report_failures(failures, "index")
+
+    ## mosaic raster files together
+    for name in index_names:
+        mosaic_fp = MOSAICS_DIR.format(name) + f"{year}.TIF"
+        print(f"\nMerging {year} {name} files and saving to {mosaic_fp} ...")
+        rasters = glob.glob(REPROJ_DIR.format(name, year) + "*.TIF")
+        write_mosaic(mosaic_fp, rasters, cog=COG_OUTPUT)
+        if DELETE_RAW_DATA:
+            for raster in rasters:
+                os.remove(raster)
+
+def main():
+    args = sys.argv[1:]
+    years = [int(arg) for arg in args]
+    for year in years:
+        assert year <= datetime.now().year
+    for name in INDEX_NAMES:
+        assert name in INDICES, f"unknown index {name}"
+    make_dirs([DATA_DIR] + [MOSAICS_DIR.format(name) for name in INDEX_NAMES])
+    for year in years:
+        get_index_mosaics_for_year(year)
+
+if __name__ == "__main__":
+    start = time.perf_counter()
+    main()
+    end = time.perf_counter()
+    print(f'\nFinished in {round(end - start, 2)} second(s)')
+    print('with love, from ozan\n')
@@ -3,6 +3,7 @@ print("\nimporting libraries ...", end=" ")
 import os
 import sys
 import gc
+import glob
 import time
 import datetime
 from dateutil.relativedelta import relativedelta
@@ -21,21 +22,46 @@ import warnings
 warnings.filterwarnings("ignore")
 
 import multiprocessing as mp
-from tqdm import tqdm
 
 from download_utils import download_raw_data
+from raster_utils import normalized_difference, write_normalized_difference, warp_normalized_difference, write_mosaic, patch_mosaic
+from scene_pool import run_scenes, run_pipeline, report_failures
+from mosaic_manifest import open_manifest, get_products, get_tiles, record_tiles
 
 print("Done\n")
 DELETE_RAW_DATA = True
+## compute NBR window by window instead of reading whole scenes into memory
+STREAM_WINDOWS = True
+## compute NBR in memory and warp it straight into the reprojected directory,
+## skipping the intermediate unprojected file
+FUSED_REPROJECT = True
+## write the final mosaic as a cloud-optimized GeoTIFF with overviews
+COG_OUTPUT = True
 MAX_PROCS = mp.cpu_count()
+## GDAL block cache per worker process, in MB
+GDAL_CACHE_MB = 256
+## only download and recompute path/rows whose newest scene changed since
+## the last run, tracked in MANIFEST_FP
+INCREMENTAL = True
+## start computing each scene as soon as its bands have downloaded,
+## instead of waiting for every download to finish
+PIPELINE = True
+## rolling acquisition window
+END_DATE = datetime.date.today()
+START_DATE = END_DATE - relativedelta(days=14)
+YEAR = END_DATE.year
+BAND_NAMES = {'SR_B5', 'SR_B7'}
 DATA_DIR = '/tmp/data/'
-B5_DIR = DATA_DIR + 'B5/'
-B7_DIR = DATA_DIR + 'B7/'
+## matches the '<band>_<year>/' folders download_raw_data writes to
+B5_DIR = DATA_DIR + f'SR_B5_{YEAR}/'
+B7_DIR = DATA_DIR + f'SR_B7_{YEAR}/'
 NBR_DIR = DATA_DIR + 'NBR/'
 REPROJ_DIR = DATA_DIR + 'NBR_RP/'
 DIRS = [DATA_DIR, B5_DIR, B7_DIR, NBR_DIR, REPROJ_DIR]
 
 NBR_RASTER_MOSAIC = "./nbr_raster_mosaic.TIF"
+MANIFEST_FP = DATA_DIR + 'mosaic_manifest.sqlite'
+MOSAIC_NAME = 'NBR'
 
 NODATA_VALUE = -20000
 REPROJ_SRS = 'EPSG:5070'
@@ -48,11 +74,7 @@ def get_nbr(band1, band2):
             band2   array (n x m)      array of second band image e.g. B7
     output: nbr     array (n x m)      normalized burn ratio
     """
-    num = band1 - band2
-    denom = band1 + band2
-    denom[denom==0] = np.nan
-    nbr = num / denom
-    return nbr
+    return normalized_difference(band1, band2)
     
 def array2raster(array, geoTransform, projection, filename, resample=True):
     """ 
@@ -95,19 +117,43 @@ def write_NBR(filename_stem: str, delete_bands=DELETE_RAW_DATA):
      - filename_stem: str
          something like'LC09_L2SP_038038_20240530_20240531_02_T1_SR_'
     Opens:
-     - /tmp/data/B5/<filename_stem>B5.TIF
-     - /tmp/data/B7/<filename_stem>B7.TIF
+     - /tmp/data/SR_B5_<year>/<filename_stem>B5.TIF
+     - /tmp/data/SR_B7_<year>/<filename_stem>B7.TIF
      Writes:
      - /tmp/data/NBR/<filename_stem>NBR.TIF
      ––––––––––––––––––––––––––––––––––––––––––––––––––
      if `delete_bands` not set to False, will also delete: 
-     - /tmp/data/B5/<filename_stem>B5.TIF
-     - /tmp/data/B7/<filename_stem>B7.TIF
+     - /tmp/data/SR_B5_<year>/<filename_stem>B5.TIF
+     - /tmp/data/SR_B7_<year>/<filename_stem>B7.TIF
+     ––––––––––––––––––––––––––––––––––––––––––––––––––
+     errors are raised rather than printed, so `run_scenes` can report
+     them per scene
     """
     ## access relevant files
     b5_fp = B5_DIR + filename_stem + 'B5.TIF'
     b7_fp = B7_DIR + filename_stem + "B7.TIF"
     nbr_fp = NBR_DIR + filename_stem + "NBR.TIF"
+    if FUSED_REPROJECT:
+        warp_normalized_difference(b5_fp, b7_fp, REPROJ_DIR + filename_stem + 'NBR.TIF', REPROJ_SRS)
+        if DELETE_RAW_DATA:
+            os.remove(b5_fp)
+            os.remove(b7_fp)
+        return
+    if STREAM_WINDOWS:
+        write_normalized_difference(b5_fp, b7_fp, nbr_fp)
+    else:
+        write_NBR_in_memory(b5_fp, b7_fp, nbr_fp)
+    ## delete raw data
+    if DELETE_RAW_DATA:
+        os.remove(b5_fp)
+        os.remove(b7_fp)
+    ## reproject data
+    reproject(nbr_fp)
+
+def write_NBR_in_memory(b5_fp: str, b7_fp: str, nbr_fp: str):
+    """
+    computes NBR from whole-scene arrays and writes it to `nbr_fp`
+    """
     ## open B5, B7, and get data
     with gdal.Open(b5_fp) as img:
         b5_data = np.array(img.GetRasterBand(1).ReadAsArray())
@@ -122,21 +168,7 @@ def write_NBR(filename_stem: str, delete_bands=DELETE_RAW_DATA):
     del b7_data
     gc.collect()
     ## write to file
-    try:
-        array2raster(nbr_data, geoTransform, crs, nbr_fp)
-        ## delete raw data
-        if DELETE_RAW_DATA:
-            os.remove(b5_fp)
-            os.remove(b7_fp)
-    except FileExistsError:
-        pass
-    except Exception as e:
-        print(f"nbr computation failed: {e}")
-    ## reproject data
-    try:
-        reproject(nbr_fp)
-    except Exception as e:
-        print(f"reprojection failed: {e}")
+    array2raster(nbr_data, geoTransform, crs, nbr_fp)
 
 def reproject(nbr_fp: str):
     """
@@ -160,23 +192,49 @@ def main():
             else: 
                 print(f"Directory '{d}' already exists.")
     ## download band 5 and band 7 data
-    b5_dir, b7_dir = download_raw_data(DATA_DIR)
-    filename_stems = [filename[:-6] for filename in os.listdir(b5_dir)]
-    
-    ## compute NBR using B5 and B7
-    ## ## this will also reproject the NBR files
-    print("\nComputing NBR and reprojecting...")
-    for filename_stem in tqdm(filename_stems):
-        write_NBR(filename_stem)
-    # # # # Tried Multiprocessing, didn't work
-    """
-    with mp.Pool(MAX_PROCS) as p:
-        [_ for _ in tqdm(p.imap_unordered(write_NBR, filename_stems), total=len(filename_stems))]
-        ##note: multiprocessing is taking a really long time
-    """
-    ## tile reprojected rasters togethers
-    rasters = glob.glob(REPROJ_DIR + "*.TIF")
-    gdal.Warp(NBR_RASTER_MOSAIC, rasters, format='GTiff', resampleAlg='bilinear', options=['-wo', 'NUM_THREADS=ALL_CPUS' '-multi', '-co', 'COMPRESS=ZSTD', ])
+    manifest = open_manifest(MANIFEST_FP)
+    try:
+        known_products = get_products(manifest, MOSAIC_NAME) if INCREMENTAL else {}
+        if PIPELINE:
+            ## compute NBR using B5 and B7 as soon as both have landed
+            ## ## this will also reproject the NBR files
+            print("\nDownloading, computing NBR and reprojecting...")
+            download = lambda on_band_ready: download_raw_data(
+                DATA_DIR, BAND_NAMES, YEAR, str(START_DATE), str(END_DATE), 
+                skip_products=known_products, on_band_ready=on_band_ready)
+            filename_stems, failures = run_pipeline(download, write_NBR, BAND_NAMES, 
+                                                    max_workers=MAX_PROCS, gdal_cache_mb=GDAL_CACHE_MB)
+            if INCREMENTAL and not filename_stems and os.path.exists(NBR_RASTER_MOSAIC):
+                print(f"{NBR_RASTER_MOSAIC} is up to date")
+                return
+        else:
+            download_raw_data(DATA_DIR, BAND_NAMES, YEAR, str(START_DATE), str(END_DATE), 
+                              skip_products=known_products)
+            filename_stems = [filename[:-6] for filename in os.listdir(B5_DIR)]
+            if INCREMENTAL and not filename_stems and os.path.exists(NBR_RASTER_MOSAIC):
+                print(f"{NBR_RASTER_MOSAIC} is up to date")
+                return
+        
+            ## compute NBR using B5 and B7
+            ## ## this will also reproject the NBR files
+            print("\nComputing NBR and reprojecting...")
+            failures = run_scenes(write_NBR, filename_stems, 
+                                  max_workers=MAX_PROCS, gdal_cache_mb=GDAL_CACHE_MB)
+        report_failures(failures, "NBR")
+        ## tile reprojected rasters togethers
+        if INCREMENTAL:
+            new_tiles = {filename_stem: REPROJ_DIR + filename_stem + 'NBR.TIF'
+                         for filename_stem in filename_stems if filename_stem not in failures}
+            record_tiles(manifest, MOSAIC_NAME, new_tiles)
+            if os.path.exists(NBR_RASTER_MOSAIC) and not COG_OUTPUT:
+                patch_mosaic(NBR_RASTER_MOSAIC, list(new_tiles.values()))
+            else:
+                write_mosaic(NBR_RASTER_MOSAIC, get_tiles(manifest, MOSAIC_NAME), cog=COG_OUTPUT)
+        else:
+            rasters = glob.glob(REPROJ_DIR + "*.TIF")
+            write_mosaic(NBR_RASTER_MOSAIC, rasters, cog=COG_OUTPUT)
+    finally:
+        manifest.close()
     
 if __name__ == "__main__":
     start = time.perf_counter()
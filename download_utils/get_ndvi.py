@@ -21,15 +21,32 @@ import warnings
 warnings.filterwarnings("ignore")
 
 import multiprocessing as mp
-from tqdm import tqdm
 
 from download_utils import download_raw_data
+from raster_utils import normalized_difference, write_normalized_difference, warp_normalized_difference, write_mosaic, patch_mosaic
+from mosaic_manifest import open_manifest, get_products, get_tiles, record_tiles
+from scene_pool import run_scenes, run_pipeline, report_failures
 
 print("Done\n")
 DELETE_RAW_DATA = True
+## compute NDVI window by window instead of reading whole scenes into memory
+STREAM_WINDOWS = True
+## compute NDVI in memory and warp it straight into the reprojected directory,
+## skipping the intermediate unprojected file
+FUSED_REPROJECT = True
+## write the final mosaics as cloud-optimized GeoTIFFs with overviews
+COG_OUTPUT = True
+## only download and recompute path/rows whose selected product changed
+## since the last run, tracked in MANIFEST_FP
+INCREMENTAL = True
+## start computing each scene as soon as its bands have downloaded,
+## instead of waiting for every download to finish
+PIPELINE = True
 BAND_NAMES = {'SR_B5', 'SR_B4'}
 
 MAX_PROCS = mp.cpu_count()
+## GDAL block cache per worker process, in MB
+GDAL_CACHE_MB = 256
 
 DATA_DIR = '/tmp/data/'
 
@@ -40,6 +57,7 @@ REPROJ_DIR = DATA_DIR + 'NDVI_RP_{0}/'
 YEAR_DIRS = [B5_DIR, B4_DIR, NDVI_DIR, REPROJ_DIR]
 
 MOSAICS_DIR = DATA_DIR + 'NDVI_mosaics/'
+MANIFEST_FP = DATA_DIR + 'mosaic_manifest.sqlite'
 CONSISTENT_DIRS = [DATA_DIR, MOSAICS_DIR]
 
 START_YEAR = 2020
@@ -54,11 +72,7 @@ def get_ndvi(band1, band2):
             band2   array (n x m)      array of second band image e.g. b5
     output: ndvi     array (n x m)      normalized burn ratio
     """
-    num = band1 - band2
-    denom = band1 + band2
-    denom[denom==0] = np.nan
-    ndvi = num / denom
-    return ndvi
+    return normalized_difference(band1, band2)
     
 def array2raster(array, geoTransform, projection, filename, resample=True):
     """ 
@@ -109,11 +123,37 @@ def write_ndvi(filename_stem: str, year: int, delete_raw_data=DELETE_RAW_DATA):
      if `delete_bands` not set to False, will also delete: 
      - /tmp/data/B5/<filename_stem>B5.TIF
      - /tmp/data/b5/<filename_stem>b5.TIF
+     ––––––––––––––––––––––––––––––––––––––––––––––––––
+     errors are raised rather than printed, so `run_scenes` can report
+     them per scene
     """
     ## access relevant files
     b5_fp = B5_DIR.format(year) + filename_stem + 'B5.TIF'
     b4_fp = B4_DIR.format(year) + filename_stem + 'B4.TIF'
     ndvi_fp = NDVI_DIR.format(year) + filename_stem + 'NDVI.TIF'
+    if FUSED_REPROJECT:
+        warp_normalized_difference(b5_fp, b4_fp, REPROJ_DIR.format(year) + filename_stem + 'NDVI.TIF', REPROJ_SRS)
+        if delete_raw_data:
+            os.remove(b5_fp)
+            os.remove(b4_fp)
+        return
+    if STREAM_WINDOWS:
+        write_normalized_difference(b5_fp, b4_fp, ndvi_fp)
+    else:
+        write_ndvi_in_memory(b5_fp, b4_fp, ndvi_fp)
+    ## delete raw data
+    if delete_raw_data:
+        os.remove(b5_fp)
+        os.remove(b4_fp)
+    ## reproject data
+    reproject(ndvi_fp, year)
+    if delete_raw_data:
+        os.remove(ndvi_fp)
+
+def write_ndvi_in_memory(b5_fp: str, b4_fp: str, ndvi_fp: str):
+    """
+    computes NDVI from whole-scene arrays and writes it to `ndvi_fp`
+    """
     ## open B5, b5, and get data
     with gdal.Open(b5_fp) as img:
         b5_data = np.array(img.GetRasterBand(1).ReadAsArray())
@@ -129,23 +169,7 @@ def write_ndvi(filename_stem: str, year: int, delete_raw_data=DELETE_RAW_DATA):
     del b4_data
     gc.collect()
     ## write to file
-    try:
-        array2raster(ndvi_data, geoTransform, crs, ndvi_fp)
-        ## delete raw data
-        if delete_raw_data:
-            os.remove(b5_fp)
-            os.remove(b4_fp)
-    except FileExistsError:
-        pass
-    except Exception as e:
-        print(f"ndvi computation failed: {e}")
-    ## reproject data
-    try:
-        reproject(ndvi_fp, year)
-        if delete_raw_data:
-            os.remove(ndvi_fp)
-    except Exception as e:
-        print(f"reprojection failed: {e}")
+    array2raster(ndvi_data, geoTransform, crs, ndvi_fp)
 
 def reproject(ndvi_fp: str, year: int):
     """
@@ -176,28 +200,58 @@ def get_ndvi_mosaic_for_year(year: int):
             print(f"Directory '{d}' already exists.")
             
     ## download raw B5/B4 data
-    download_raw_data(DATA_DIR, BAND_NAMES, year)
-    
-    ##Compute NDVI and Reproject
-    print("\nComputing NDVI and reprojecting...")
-    filename_stems = [filename[:-6] for filename in os.listdir(B5_DIR.format(year))]
-    for filename_stem in tqdm(filename_stems):
-        write_ndvi(filename_stem, year)
+    manifest = open_manifest(MANIFEST_FP)
+    try:
+        mosaic_name = f"NDVI_{year}"
+        mosaic_fp = MOSAICS_DIR + f"{year}.TIF"
+        known_products = get_products(manifest, mosaic_name) if INCREMENTAL else {}
+        if PIPELINE:
+            print("\nDownloading, computing NDVI and reprojecting...")
+            download = lambda on_band_ready: download_raw_data(
+                DATA_DIR, BAND_NAMES, year, skip_products=known_products, on_band_ready=on_band_ready)
+            filename_stems, failures = run_pipeline(download, write_ndvi, BAND_NAMES, year, 
+                                                    max_workers=MAX_PROCS, gdal_cache_mb=GDAL_CACHE_MB)
+            if INCREMENTAL and not filename_stems and os.path.exists(mosaic_fp):
+                print(f"{mosaic_fp} is up to date")
+                return
+        else:
+            download_raw_data(DATA_DIR, BAND_NAMES, year, skip_products=known_products)
+        
+            ##Compute NDVI and Reproject
+            print("\nComputing NDVI and reprojecting...")
+            filename_stems = [filename[:-6] for filename in os.listdir(B5_DIR.format(year))]
+            if INCREMENTAL and not filename_stems and os.path.exists(mosaic_fp):
+                print(f"{mosaic_fp} is up to date")
+                return
+            failures = run_scenes(write_ndvi, filename_stems, year, 
+                                  max_workers=MAX_PROCS, gdal_cache_mb=GDAL_CACHE_MB)
+        report_failures(failures, "NDVI")
     
-    ## mosaic raster files together
-    mosaic_fp = MOSAICS_DIR + f"{year}.TIF"
-    print(f"\nMerging {year} NDVI files and saving to {mosaic_fp} ...")
-    rasters = glob.glob(REPROJ_DIR.format(year) + "*.TIF")
-    gdal.Warp(mosaic_fp, rasters, 
-              format='GTiff', resampleAlg='bilinear', 
-              options=['-wo', 'NUM_THREADS=ALL_CPUS', '-multi',
-                       '-co', 'COMPRESS=ZSTD',])
+        ## mosaic raster files together
+        print(f"\nMerging {year} NDVI files and saving to {mosaic_fp} ...")
+        if INCREMENTAL:
+            new_tiles = {filename_stem: REPROJ_DIR.format(year) + filename_stem + 'NDVI.TIF'
+                         for filename_stem in filename_stems if filename_stem not in failures}
+            record_tiles(manifest, mosaic_name, new_tiles)
+            if os.path.exists(mosaic_fp) and not COG_OUTPUT:
+                patch_mosaic(mosaic_fp, list(new_tiles.values()))
+            else:
+                write_mosaic(mosaic_fp, get_tiles(manifest, mosaic_name), cog=COG_OUTPUT)
+        else:
+            rasters = glob.glob(REPROJ_DIR.format(year) + "*.TIF")
+            write_mosaic(mosaic_fp, rasters, cog=COG_OUTPUT)
+    finally:
+        manifest.close()
     
     ## remove old directories
+    ## incremental runs keep the reprojected tiles to rebuild the mosaic from
     if DELETE_RAW_DATA:
-        for raster in rasters:
-            os.remove(raster)
+        if not INCREMENTAL:
+            for raster in rasters:
+                os.remove(raster)
         for d in YEAR_DIRS:
+            if INCREMENTAL and d == REPROJ_DIR:
+                continue
             os.rmdir(d.format(year))
 
 def main():
@@ -217,7 +271,10 @@ def main():
             print(f"Directory '{d}' already exists.")
             
     done_years = [int(file[:4]) for file in os.listdir(MOSAICS_DIR)]
-    relevant_years = [year for year in years if year not in done_years]
+    if INCREMENTAL:
+        relevant_years = years
+    else:
+        relevant_years = [year for year in years if year not in done_years]
     #current_year = datetime.now().year
     #relevant_years = [year for year in range(START_YEAR, current_year+1) if year not in done_years]
     for year in relevant_years:
@@ -0,0 +1,73 @@
+import os
+import sqlite3
+import datetime
+
+## one row per (mosaic, WRS-2 path/row): the Landsat product that tile was
+## computed from and where the reprojected tile lives
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tiles (
+    mosaic      TEXT NOT NULL,
+    path_row    TEXT NOT NULL,
+    product_id  TEXT NOT NULL,
+    tile_fp     TEXT NOT NULL,
+    updated     TEXT NOT NULL,
+    PRIMARY KEY (mosaic, path_row)
+)
+"""
+
+def open_manifest(manifest_fp: str):
+    """
+    opens (creating if needed) the sqlite manifest at `manifest_fp`
+    """
+    conn = sqlite3.connect(manifest_fp)
+    conn.execute(SCHEMA)
+    conn.commit()
+    return conn
+
+def parse_filename_stem(filename_stem: str):
+    """
+    'LC09_L2SP_038038_20240530_20240531_02_T1_SR_'
+     -> ('038038', 'LC09_L2SP_038038_20240530_20240531_02_T1')
+    """
+    product_id = filename_stem[:-len('_SR_')]
+    return product_id.split('_')[2], product_id
+
+def get_products(conn, mosaic: str):
+    """
+    returns {path/row: product id} for every tile currently in `mosaic`
+    """
+    rows = conn.execute("SELECT path_row, product_id FROM tiles WHERE mosaic = ?", (mosaic,))
+    return dict(rows.fetchall())
+
+def get_tiles(conn, mosaic: str):
+    """
+    returns the reprojected tile filenames that make up `mosaic`
+    """
+    rows = conn.execute("SELECT tile_fp FROM tiles WHERE mosaic = ? ORDER BY path_row", (mosaic,))
+    return [tile_fp for (tile_fp,) in rows.fetchall()]
+
+def record_tile(conn, mosaic: str, path_row: str, product_id: str, tile_fp: str):
+    """
+    records that `tile_fp`, computed from `product_id`, is the tile for
+    `path_row` in `mosaic`
+    returns the filename of the tile it replaced, or None
+    """
+    row = conn.execute("SELECT tile_fp FROM tiles WHERE mosaic = ? AND path_row = ?",
+                       (mosaic, path_row)).fetchone()
+    conn.execute("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?)",
+                 (mosaic, path_row, product_id, tile_fp, datetime.datetime.now().isoformat()))
+    conn.commit()
+    if row is None or row[0] == tile_fp:
+        return None
+    return row[0]
+
+def record_tiles(conn, mosaic: str, tile_fps: dict):
+    """
+    records every {filename_stem: tile_fp} in `tile_fps` as the current tile
+    for its path/row, deleting the tile files they replace
+    """
+    for filename_stem, tile_fp in tile_fps.items():
+        path_row, product_id = parse_filename_stem(filename_stem)
+        old_tile_fp = record_tile(conn, mosaic, path_row, product_id, tile_fp)
+        if old_tile_fp is not None and os.path.exists(old_tile_fp):
+            os.remove(old_tile_fp)
@@ -0,0 +1,151 @@
+import os
+import numpy as np
+from osgeo import gdal
+
+NODATA_VALUE = -20000
+SCALE_FACTOR = 10000
+## a window is always at least this many rows tall, so striped rasters
+## (1-row blocks) are not read one scanline at a time
+MIN_WINDOW_ROWS = 256
+GTIFF_OPTIONS = ['COMPRESS=ZSTD', 'TILED=YES']
+
+def iter_windows(band, min_rows=MIN_WINDOW_ROWS):
+    """
+    yields (xoff, yoff, xsize, ysize) windows that walk `band` top to bottom
+    windows span the full raster width and are a whole number of native
+    blocks tall, so every block is decoded exactly once
+    """
+    _, block_y = band.GetBlockSize()
+    rows = block_y * max(1, -(-min_rows // block_y))
+    for yoff in range(0, band.YSize, rows):
+        yield 0, yoff, band.XSize, min(rows, band.YSize - yoff)
+
+def normalized_difference(band1, band2):
+    """
+    computes (band1 - band2) / (band1 + band2) in float32
+    input:  band1   array (n x m)      e.g. B5
+            band2   array (n x m)      e.g. B7 for NBR, B4 for NDVI
+    output: index   array (n x m)      nan where band1 + band2 == 0
+    """
+    band1 = band1.astype(np.float32, copy=False)
+    band2 = band2.astype(np.float32, copy=False)
+    num = band1 - band2
+    denom = band1 + band2
+    denom[denom == 0] = np.nan
+    return np.divide(num, denom, out=num)
+
+def scale_index(index):
+    """
+    converts a float index in [-1, 1] to the int16 encoding used on disk
+    (index * 10000, with nan/inf mapped to NODATA_VALUE)
+    """
+    np.nan_to_num(index, copy=False, nan=-2, posinf=-2, neginf=-2)
+    return np.round(index * SCALE_FACTOR).astype(np.int16)
+
+def create_like(src_ds, filename, driver='GTiff', options=GTIFF_OPTIONS):
+    """
+    creates an empty single band Int16 raster with the size, geotransform
+    and projection of `src_ds`
+    """
+    dataset = gdal.GetDriverByName(driver).Create(
+        filename,
+        src_ds.RasterXSize,
+        src_ds.RasterYSize,
+        1,
+        gdal.GDT_Int16,
+        options=options)
+    dataset.SetGeoTransform(src_ds.GetGeoTransform())
+    dataset.SetProjection(src_ds.GetProjection())
+    dataset.GetRasterBand(1).SetNoDataValue(NODATA_VALUE)
+    return dataset
+
+def fill_normalized_difference(img1, img2, dataset):
+    """
+    streams the normalized difference of the first bands of `img1` and
+    `img2` into the first band of `dataset`, one window at a time
+    """
+    band1 = img1.GetRasterBand(1)
+    band2 = img2.GetRasterBand(1)
+    out_band = dataset.GetRasterBand(1)
+    for xoff, yoff, xsize, ysize in iter_windows(band1):
+        index = normalized_difference(
+            band1.ReadAsArray(xoff, yoff, xsize, ysize),
+            band2.ReadAsArray(xoff, yoff, xsize, ysize))
+        out_band.WriteArray(scale_index(index), xoff, yoff)
+
+def write_normalized_difference(band1_fp, band2_fp, out_fp):
+    """
+    streams the normalized difference of two single band rasters to `out_fp`
+    input:  band1_fp    string      e.g. <filename_stem>B5.TIF
+            band2_fp    string      e.g. <filename_stem>B7.TIF
+            out_fp      string      output filename
+    only one window of each band is held in memory at a time, so peak memory
+    is bounded by the window size rather than the scene size
+    """
+    with gdal.Open(band1_fp) as img1, gdal.Open(band2_fp) as img2:
+        dataset = create_like(img1, out_fp)
+        fill_normalized_difference(img1, img2, dataset)
+        dataset.FlushCache()  # Write to disk.
+        del dataset
+
+def warp_normalized_difference(band1_fp, band2_fp, out_fp, dst_srs):
+    """
+    computes the normalized difference of two single band rasters into an
+    in-memory Int16 dataset and warps it straight to `out_fp` in `dst_srs`
+    input:  band1_fp    string      e.g. <filename_stem>B5.TIF
+            band2_fp    string      e.g. <filename_stem>B7.TIF
+            out_fp      string      reprojected output filename
+            dst_srs     string      e.g. 'EPSG:5070'
+    the unprojected index never touches disk, so each scene is compressed
+    and written once instead of twice
+    """
+    with gdal.Open(band1_fp) as img1, gdal.Open(band2_fp) as img2:
+        mem_ds = create_like(img1, '', driver='MEM', options=[])
+        fill_normalized_difference(img1, img2, mem_ds)
+    gdal.Warp(out_fp, mem_ds, dstSRS=dst_srs,
+              dstNodata=NODATA_VALUE, srcNodata=NODATA_VALUE,
+              creationOptions=GTIFF_OPTIONS)
+    del mem_ds
+
+## PREDICTOR=YES lets the COG driver pick horizontal differencing for
+## integer rasters and floating point prediction for float rasters
+COG_OPTIONS = ['COMPRESS=ZSTD', 'PREDICTOR=YES', 'BLOCKSIZE=512',
+               'OVERVIEWS=IGNORE_EXISTING', 'OVERVIEW_RESAMPLING=AVERAGE',
+               'NUM_THREADS=ALL_CPUS', 'BIGTIFF=IF_SAFER']
+
+def write_mosaic(mosaic_fp, rasters, cog=True):
+    """
+    mosaics `rasters` into `mosaic_fp`
+    input:  mosaic_fp   string      output filename
+            rasters     list        input filenames, all in the same srs
+            cog         bool        write a tiled cloud-optimized GeoTIFF
+                                    with internal overviews, so clients can
+                                    read only the tiles and zoom level they
+                                    need; otherwise a plain striped GeoTIFF
+    """
+    ## write next to the old mosaic and swap it in at the end, so readers
+    ## never see a half written file and gdal.Warp never appends to it
+    tmp_fp = mosaic_fp + '.part'
+    if os.path.exists(tmp_fp):
+        os.remove(tmp_fp)
+    if cog:
+        gdal.Warp(tmp_fp, rasters,
+                  format='COG', resampleAlg='bilinear', multithread=True,
+                  warpOptions=['NUM_THREADS=ALL_CPUS'],
+                  creationOptions=COG_OPTIONS)
+    else:
+        gdal.Warp(tmp_fp, rasters,
+                  format='GTiff', resampleAlg='bilinear',
+                  options=['-wo', 'NUM_THREADS=ALL_CPUS', '-multi',
+                           '-co', 'COMPRESS=ZSTD',])
+    os.replace(tmp_fp, mosaic_fp)
+
+def patch_mosaic(mosaic_fp, rasters):
+    """
+    warps `rasters` into the existing GeoTIFF mosaic at `mosaic_fp` in place,
+    overwriting only the regions they cover
+    COGs cannot be updated in place, rebuild those with `write_mosaic`
+    """
+    with gdal.Open(mosaic_fp, gdal.GA_Update) as mosaic:
+        gdal.Warp(mosaic, rasters, resampleAlg='bilinear', multithread=True,
+                  warpOptions=['NUM_THREADS=ALL_CPUS'])
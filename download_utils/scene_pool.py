@@ -0,0 +1,199 @@
+import os
+import queue
+import threading
+import traceback
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+from osgeo import gdal
+from tqdm import tqdm
+
+GDAL_CACHE_MB = 256
+# a worker dying (e.g. OOM-killed) breaks the whole pool and every scene
+# still in it. those scenes run again on a fresh pool, a scene is only
+# reported failed once it was in this many broken pools
+MAX_POOL_ATTEMPTS = 2
+
+def init_worker(gdal_cache_mb: int):
+    """
+    runs once in every worker process
+     - caps GDAL's block cache, which otherwise defaults to 5% of RAM
+       *per process* and makes N workers fight over memory
+     - keeps GDAL single threaded, the pool already uses every core
+     - makes GDAL raise instead of returning None on failure
+    """
+    gdal.UseExceptions()
+    gdal.SetCacheMax(gdal_cache_mb * 1024 * 1024)
+    gdal.SetConfigOption('GDAL_NUM_THREADS', '1')
+
+def run_scene(func, filename_stem: str, args: tuple):
+    """
+    calls func(filename_stem, *args) and returns (filename_stem, error)
+    where error is None on success or the formatted traceback on failure
+    """
+    try:
+        func(filename_stem, *args)
+        return filename_stem, None
+    except Exception:
+        return filename_stem, traceback.format_exc()
+
+def run_scenes(func, filename_stems, *args, max_workers=None, gdal_cache_mb=GDAL_CACHE_MB):
+    """
+    runs func(filename_stem, *args) for every scene on a process pool
+    input:  func            callable    module level function, e.g. write_NBR
+            filename_stems  list        only file name stems are sent to the
+                                        workers, which open the bands themselves
+            args                        extra arguments passed to every call
+            max_workers     int         defaults to the number of cores
+            gdal_cache_mb   int         GDAL block cache per worker
+    output: failures        dict        filename_stem -> traceback string
+    """
+    max_workers = max_workers or mp.cpu_count()
+    failures = {}
+    attempts = {}
+    pending = list(filename_stems)
+    with tqdm(total=len(pending)) as progress:
+        while pending:
+            broken = []
+            with ProcessPoolExecutor(max_workers=max_workers,
+                                     initializer=init_worker,
+                                     initargs=(gdal_cache_mb,)) as pool:
+                futures = {}
+                for i, filename_stem in enumerate(pending):
+                    try:
+                        futures[pool.submit(run_scene, func, filename_stem, args)] = filename_stem
+                    except BrokenProcessPool:
+                        # never started, doesn't count as an attempt
+                        broken.extend(pending[i:])
+                        break
+                for future in as_completed(futures):
+                    filename_stem = futures[future]
+                    try:
+                        filename_stem, error = future.result()
+                    except BrokenProcessPool:
+                        attempts[filename_stem] = attempts.get(filename_stem, 0) + 1
+                        if attempts[filename_stem] < MAX_POOL_ATTEMPTS:
+                            broken.append(filename_stem)
+                            continue
+                        error = traceback.format_exc()
+                    except Exception:
+                        error = traceback.format_exc()
+                    if error is not None:
+                        failures[filename_stem] = error
+                    progress.update()
+            if broken:
+                print(f"\n    worker pool broke, running {len(broken)} scene(s) again")
+            pending = broken
+    return failures
+
+def run_pipeline(download, func, band_names, *args, max_workers=None, gdal_cache_mb=GDAL_CACHE_MB, max_pending=None):
+    """
+    overlaps downloading with per-scene processing: func(filename_stem, *args)
+    is queued as soon as every band in `band_names` has landed for a scene
+    input:  download        callable    download(on_band_ready) fetches the
+                                        bands, calling on_band_ready(band_fp)
+                                        for each file as it lands
+            func, args                  as in `run_scenes`
+            band_names      set         e.g. {'SR_B5', 'SR_B4'}
+            max_pending     int         scenes ready or running at once;
+                                        when full, the downloader waits,
+                                        which bounds the disk used by
+                                        bands that are not processed yet
+    output: filename_stems  list        every scene that was processed
+            failures        dict        filename_stem -> traceback string
+    if a worker dies the pool can't take new scenes, the rest are still
+    taken off the queue so the downloads finish, and every scene the
+    broken pool lost is run again with `run_scenes` afterwards
+    """
+    max_workers = max_workers or mp.cpu_count()
+    max_pending = max_pending or 2 * max_workers
+    band_names = set(band_names)
+    ready = queue.Queue(maxsize=max_pending)
+    landed = {}
+    landed_lock = threading.Lock()
+
+    def on_band_ready(band_fp):
+        filename = os.path.basename(band_fp)
+        filename_stem, band = filename[:-6], filename[-9:-4]
+        with landed_lock:
+            bands = landed.setdefault(filename_stem, set())
+            complete = band not in bands and (bands | {band}) >= band_names
+            bands.add(band)
+        if complete:
+            ready.put(filename_stem)
+
+    futures = {}
+    # scenes lost to a dead worker, they run again once downloads are done
+    broken = []
+    failures = {}
+    ## download threads are running while workers start, and forking a
+    ## process with live threads is unsafe, so start workers fresh
+    with ProcessPoolExecutor(max_workers=max_workers,
+                             mp_context=mp.get_context('spawn'),
+                             initializer=init_worker,
+                             initargs=(gdal_cache_mb,)) as pool:
+        in_flight = threading.Semaphore(max_pending)
+
+        def submit_ready():
+            stopped = False
+            while True:
+                filename_stem = ready.get()
+                if filename_stem is None:
+                    return
+                if stopped:
+                    # nothing can be submitted anymore, keep taking scenes
+                    # off the queue so the downloads don't block on it
+                    broken.append(filename_stem)
+                    continue
+                in_flight.acquire()
+                try:
+                    future = pool.submit(run_scene, func, filename_stem, args)
+                except BrokenProcessPool:
+                    broken.append(filename_stem)
+                    stopped = True
+                    continue
+                except Exception:
+                    failures[filename_stem] = traceback.format_exc()
+                    stopped = True
+                    continue
+                future.add_done_callback(lambda _: in_flight.release())
+                futures[future] = filename_stem
+
+        submitter = threading.Thread(target=submit_ready)
+        submitter.start()
+        try:
+            download(on_band_ready)
+        finally:
+            ready.put(None)
+            submitter.join()
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            filename_stem = futures[future]
+            try:
+                filename_stem, error = future.result()
+            except BrokenProcessPool:
+                broken.append(filename_stem)
+                continue
+            except Exception:
+                error = traceback.format_exc()
+            if error is not None:
+                failures[filename_stem] = error
+    submitted = set(futures.values())
+    filename_stems = list(futures.values()) + [filename_stem for filename_stem in broken + list(failures)
+                                               if filename_stem not in submitted]
+    if broken:
+        # downloads are done, so these go through a regular pool
+        print(f"\n    worker pool broke, running {len(broken)} scene(s) again")
+        failures.update(run_scenes(func, broken, *args, max_workers=max_workers, gdal_cache_mb=gdal_cache_mb))
+    return filename_stems, failures
+
+def report_failures(failures: dict, task_name: str):
+    """
+    prints one entry per failed scene
+    """
+    if not failures:
+        return
+    print(f"\n{len(failures)} {task_name} scene(s) failed:")
+    for filename_stem, error in sorted(failures.items()):
+        print(f"  - {filename_stem}")
+        print("    " + error.strip().replace("\n", "\n    "))
@@ -0,0 +1,72 @@
+import numpy as np
+from osgeo import gdal
+
+from raster_utils import (iter_windows, normalized_difference, scale_index,
+                          create_like, GTIFF_OPTIONS, NODATA_VALUE)
+
+## every index here is a normalized difference (a - b) / (a + b) of two
+## Landsat 8/9 OLI surface reflectance bands
+## dNBR is the difference of a pre- and post-fire NBR mosaic, so requesting
+## NBR for both years produces its inputs
+INDICES = {
+    'NBR':  ('SR_B5', 'SR_B7'),
+    'NBR2': ('SR_B6', 'SR_B7'),
+    'NDVI': ('SR_B5', 'SR_B4'),
+    'NDMI': ('SR_B5', 'SR_B6'),
+}
+
+def required_bands(index_names):
+    """
+    returns the sorted list of bands needed to compute every index in
+    `index_names`, each band listed once
+    """
+    return sorted({band for name in index_names for band in INDICES[name]})
+
+def band_filename(filename_stem: str, band: str):
+    """
+    'LC09_L2SP_038038_20240530_20240531_02_T1_SR_', 'SR_B5'
+     -> 'LC09_L2SP_038038_20240530_20240531_02_T1_SR_B5.TIF'
+    """
+    return filename_stem + band[-2:] + '.TIF'
+
+def write_indices(band_fps: dict, out_fps: dict, dst_srs=None):
+    """
+    computes every requested index in a single pass over the input bands
+    input:  band_fps    dict      band name -> raster filename
+                                  e.g. {'SR_B4': ..., 'SR_B5': ..., 'SR_B7': ...}
+            out_fps     dict      index name -> output filename
+                                  e.g. {'NBR': ..., 'NDVI': ...}
+            dst_srs     string    if set, indices are built in memory and
+                                  warped straight to `out_fps` in this srs
+    each window of each band is read and decoded once no matter how many
+    indices use it
+    """
+    bands = required_bands(out_fps)
+    imgs = {band: gdal.Open(band_fps[band]) for band in bands}
+    ref_img = imgs[bands[0]]
+    if dst_srs is None:
+        datasets = {name: create_like(ref_img, out_fp)
+                    for name, out_fp in out_fps.items()}
+    else:
+        datasets = {name: create_like(ref_img, '', driver='MEM', options=[])
+                    for name in out_fps}
+    ## walk the bands window by window
+    in_bands = {band: img.GetRasterBand(1) for band, img in imgs.items()}
+    out_bands = {name: dataset.GetRasterBand(1) for name, dataset in datasets.items()}
+    for xoff, yoff, xsize, ysize in iter_windows(in_bands[bands[0]]):
+        data = {band: in_band.ReadAsArray(xoff, yoff, xsize, ysize).astype(np.float32)
+                for band, in_band in in_bands.items()}
+        for name, out_band in out_bands.items():
+            band1, band2 = INDICES[name]
+            index = normalized_difference(data[band1], data[band2])
+            out_band.WriteArray(scale_index(index), xoff, yoff)
+    del in_bands, out_bands, imgs, ref_img
+    ## write to disk
+    for name, dataset in datasets.items():
+        if dst_srs is None:
+            dataset.FlushCache()
+        else:
+            gdal.Warp(out_fps[name], dataset, dstSRS=dst_srs,
+                      dstNodata=NODATA_VALUE, srcNodata=NODATA_VALUE,
+                      creationOptions=GTIFF_OPTIONS)
+    del datasets
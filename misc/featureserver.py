@@ -0,0 +1,157 @@
+import os
+import json
+import time
+import hashlib
+import numpy as np
+import shapely
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+
+# small client for ArcGIS FeatureServer layers
+#  - pages by objectId range, at most PAGE_SIZE_MAX records per request
+#  - runs pages on a bounded thread pool over one pooled session
+#  - retries with exponential backoff instead of looping forever
+#  - caches each response under CACHE_DIR keyed by the query and the
+#    layer's last edit date, so reruns against unchanged layers only
+#    request the layer's metadata
+MAX_THREADS = 8
+PAGE_SIZE_MAX = 800
+MAX_RETRIES = 6
+BACKOFF_BASE = 2 # seconds, doubled after every failed attempt
+BACKOFF_MAX = 60
+TIMEOUT = 60
+# the ArcGIS hosts this is used against have had certificate issues
+VERIFY_SSL = False
+CACHE_DIR = "./data/featureserver_cache/"
+
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_connections=MAX_THREADS, pool_maxsize=MAX_THREADS))
+session.mount("http://", HTTPAdapter(pool_connections=MAX_THREADS, pool_maxsize=MAX_THREADS))
+
+def get_json(url, params):
+    """
+    GETs `url` and returns the parsed JSON, retrying with exponential
+    backoff up to MAX_RETRIES times before raising
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            response = session.get(url, params=params, timeout=TIMEOUT, verify=VERIFY_SSL)
+            response.raise_for_status()
+            data = response.json()
+            # ArcGIS reports failed queries as HTTP 200 with an error body
+            if 'error' in data:
+                raise requests.RequestException(f"{url}: {data['error']}")
+            return data
+        except (requests.RequestException, ValueError) as e:
+            if attempt == MAX_RETRIES:
+                raise
+            delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)
+            print(f"    Failed to load {url} ({e}). Retrying in {delay}s.")
+            time.sleep(delay)
+
+def get_edit_date(layer_info):
+    """
+    the layer's last data edit in ms since the epoch, or None if the service
+    doesn't report one (responses are not cached then)
+    """
+    editing_info = layer_info.get('editingInfo') or {}
+    return editing_info.get('dataLastEditDate') or editing_info.get('lastEditDate')
+
+def cache_fp(layer_url, params, edit_date):
+    key = json.dumps([layer_url, sorted(params.items()), edit_date])
+    return CACHE_DIR + hashlib.sha256(key.encode()).hexdigest() + ".json"
+
+def query(layer_url, params, edit_date=None):
+    """
+    runs `params` against the layer's query endpoint, reading and writing
+    the on-disk cache when `edit_date` is known
+    """
+    if edit_date is None:
+        return get_json(layer_url + "/query", params)
+    fp = cache_fp(layer_url, params, edit_date)
+    if os.path.exists(fp):
+        with open(fp) as f:
+            return json.load(f)
+    data = get_json(layer_url + "/query", params)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(fp + ".part", "w") as f:
+        json.dump(data, f)
+    os.replace(fp + ".part", fp)
+    return data
+
+def get_pages(object_ids, page_size):
+    """
+    splits the sorted `object_ids` into (first id, last id) ranges of at
+    most `page_size` records each
+    """
+    return [(object_ids[i], object_ids[min(i + page_size, len(object_ids)) - 1])
+            for i in range(0, len(object_ids), page_size)]
+
+def query_features(layer_url, where="1=1", out_fields="*", out_sr=None, f="geojson", max_threads=MAX_THREADS):
+    """
+    returns every feature of the layer at `layer_url` matching `where`
+    input:  layer_url   str     e.g. '.../FeatureServer/0'
+            where       str     SQL where clause
+            out_fields  str     comma separated field names
+            out_sr      int     output spatial reference, the layer's by default
+            f           str     'geojson' or 'json' (Esri JSON)
+    output: features    list    the 'features' of every page, in objectId order
+    """
+    layer_url = layer_url.rstrip("/")
+    layer_info = get_json(layer_url, {'f': 'json'})
+    edit_date = get_edit_date(layer_info)
+    page_size = min(int(layer_info.get('maxRecordCount', PAGE_SIZE_MAX)), PAGE_SIZE_MAX)
+
+    ids = query(layer_url, {'where': where, 'returnIdsOnly': 'true', 'f': 'json'}, edit_date)
+    id_field = ids['objectIdFieldName']
+    object_ids = sorted(ids['objectIds'] or [])
+    print(f"\n    Number of target records: {len(object_ids)}")
+
+    params = {'outFields': out_fields, 'returnGeometry': 'true', 'f': f}
+    if out_sr is not None:
+        params['outSR'] = out_sr
+    def load_page(page):
+        from_id, to_id = page
+        page_where = f"({where}) AND {id_field} >= {from_id} AND {id_field} <= {to_id}"
+        return query(layer_url, dict(params, where=page_where), edit_date)['features']
+
+    pages = get_pages(object_ids, page_size)
+    print(f"    Number of requests: {len(pages)}")
+    with ThreadPoolExecutor(max_workers=max_threads) as executor:
+        return [feature for features in executor.map(load_page, pages) for feature in features]
+
+def get_rings(feature):
+    return (feature.get('geometry') or {}).get('rings') or []
+
+def esri_polygons(features):
+    """
+    builds shapely geometries from Esri JSON polygon features in a few
+    array calls. Esri rings are clockwise for outer rings and
+    counter-clockwise for holes, a hole belongs to the outer ring before it
+    output: numpy array with a Polygon or MultiPolygon per feature, None
+            for features without rings
+    """
+    ring_counts = np.array([len(get_rings(feature)) for feature in features], dtype=np.int64)
+    out = np.full(len(features), None, dtype=object)
+    if ring_counts.sum() == 0:
+        return out
+    rings = [np.asarray(ring, dtype=np.float64)[:, :2] for feature in features for ring in get_rings(feature)]
+    ring_index = np.repeat(np.arange(len(rings)), [len(ring) for ring in rings])
+    rings = shapely.linearrings(np.concatenate(rings), indices=ring_index)
+
+    feature_index = np.repeat(np.arange(len(features)), ring_counts)
+    is_shell = ~shapely.is_ccw(rings)
+    # the first ring of a feature always starts a part
+    is_shell[np.cumsum(ring_counts)[ring_counts > 0] - ring_counts[ring_counts > 0]] = True
+    parts = shapely.polygons(rings, indices=np.cumsum(is_shell) - 1)
+    part_feature_index = feature_index[is_shell]
+
+    part_counts = np.bincount(part_feature_index, minlength=len(features))
+    single = part_counts[part_feature_index] == 1
+    out[part_feature_index[single]] = parts[single]
+    multi = ~single
+    if multi.any():
+        multi_features, multi_index = np.unique(part_feature_index[multi], return_inverse=True)
+        out[multi_features] = shapely.multipolygons(parts[multi], indices=multi_index)
+    return out
@@ -1,19 +1,21 @@
 import os
-import json
 import time
-import datetime
-import requests
-import urllib.parse
-import urllib.request
 import warnings
+import numpy as np
 import geopandas as gpd
 import pandas as pd
-from osgeo import gdal, ogr
-from shapely import wkt
+import shapely
+from osgeo import gdal, ogr, osr
+from shapely import wkt, STRtree
 import tqdm
 # remove warnings
 import multiprocessing as mp
 
+from wkb_utils import pack_wkb, unpack_wkb, save_wkb, load_wkb, geometry_hash, feature_hashes
+from shared_arrays import share_arrays, attach_arrays, release
+from featureserver import query_features, esri_polygons
+import intersection_store
+
 warnings.filterwarnings('ignore')
 
 
@@ -21,29 +23,49 @@ DATA_DIR = "./data/"
 FIRE_FP = DATA_DIR + "fire.geojson"
 TREAT_DIR = DATA_DIR + "treatment/"
 TREAT_FPS = ["point.geojson", "line.geojson", "poly.geojson"]
-OUT_FILENAME = "fire_treatment_intersections.csv"
+# results are appended as the workers finish. FlatGeobuf stores WKB
+# geometries with typed columns, 'CSV' writes WKT strings instead
+OUT_FORMAT = "FlatGeobuf"
+OUT_FILENAME = "fire_treatment_intersections.fgb"
 NUM_TREATMENT_FEATURES = 3
+BUFFER_DISTANCE = 20
+# OGR's Buffer uses 30 segments per quarter circle
+BUFFER_QUAD_SEGS = 30
+BUFFER_CACHE_DIR = DATA_DIR + "buffer_cache/"
+# intersect on shapely 2 geometry arrays instead of per-row OGR geometries
+VECTORIZED = True
+# share fire and treatment geometries with the workers as WKB in shared
+# memory and send them chunks of fires, instead of one fire per task
+SHARED_MEMORY = True
+FIRE_CHUNK_SIZE = 64
+# keep results in STORE_FP between runs and only recompute pairs whose fire
+# or treatment was added, removed or changed since the last run
+INCREMENTAL = True
+STORE_FP = DATA_DIR + "intersections.sqlite"
 
-def make_valid(geo):
-    if not geo.is_valid:
-        #this is only one way to make an invalid geometry valid
-        return geo.buffer(0)
-    return geo
+# low-cardinality fire attributes, stored as pandas categoricals
+FIRE_CATEGORIES = ['year_', 'state', 'agency', 'unit_id', 'cause', 'c_method', 'objective']
 
 def process_fire_data(data):
-    for feat in data['features']:
-        geo = {'type':'polygon', 'coordinates':feat['geometry']['rings']}
-        feat['geometry'] = geo
-        feat['properties'] = feat['attributes']
-        del feat['attributes']
-    fires = gpd.GeoDataFrame.from_features(data['features'], crs='EPSG:4269')
-    #fires.loc[not fires['geometry'].is_valid, :] = fires.loc[fires['geometry'].is_valid, 'geometry'].apply(make_valid)
-    fires['geometry'] = fires['geometry'].apply(make_valid)
-    #fires = fires.loc[fires['geometry'].is_valid, :]
-    columns_lower = { col: col.lower() for col in fires.columns}
-    fires = fires.rename(columns=columns_lower)
-    fires['alarm_date'] = [datetime.datetime.fromtimestamp(ms/1000.0) for ms in fires['alarm_date']]
-    fires['cont_date'] = [datetime.datetime.fromtimestamp(ms/1000.0) for ms in fires['cont_date']]
+    """
+    builds the fires GeoDataFrame straight from the Esri JSON features:
+    geometries, validity repair and date parsing are all array operations
+    """
+    features = data['features']
+    fires = pd.DataFrame.from_records([feat['attributes'] for feat in features])
+    fires.columns = fires.columns.str.lower()
+    geoms = esri_polygons(features)
+    #this is only one way to make an invalid geometry valid
+    invalid = ~shapely.is_valid(geoms) & ~shapely.is_missing(geoms)
+    geoms[invalid] = shapely.buffer(geoms[invalid], 0)
+    # fires without rings, or that the repair left empty, can't be intersected
+    keep = ~(shapely.is_missing(geoms) | shapely.is_empty(geoms))
+    fires = gpd.GeoDataFrame(fires.loc[keep].reset_index(drop=True), geometry=geoms[keep], crs='EPSG:4269')
+    fires['alarm_date'] = pd.to_datetime(fires['alarm_date'], unit='ms')
+    fires['cont_date'] = pd.to_datetime(fires['cont_date'], unit='ms')
+    for col in FIRE_CATEGORIES:
+        if col in fires.columns:
+            fires[col] = fires[col].astype('category')
     fires = fires.set_index('objectid')
     fires = fires.to_crs(32611) 
     return fires
@@ -52,29 +74,10 @@ def get_fire_data():
     base_url = "https://services1.arcgis.com/jUJYIo9tSA7EHvfZ/arcgis/rest/services/California_Fire_Perimeters/FeatureServer/0/"
     start = time.perf_counter()
     
-    # Get record extract limit
-    url_string = base_url + "?f=json"
-    j = urllib.request.urlopen(url_string)
-    js = json.load(j)
-    max_records_count = int(js["maxRecordCount"])
-    max_records_count = min(max_records_count, 800)
-    
-    # get count of objects
-    count_query = "query?where=%20(YEAR_%20%3D%202022%20OR%20YEAR_%20%3D%209999)%20&outFields=*&returnCountOnly=true&outSR=4326&f=json"
-    url_string = base_url + count_query
-    j = urllib.request.urlopen(url_string)
-    js = json.load(j)
-    num_of_records = js['count']
-    print(("\n    Number of target records: %s" % num_of_records))
-    
-    gather_query = "query?where=%20(YEAR_%20%3D%202022%20OR%20YEAR_%20%3D%209999)%20&outFields=*&outSR=4326&f=json"
-    url_string = base_url + gather_query
-    resp = requests.get(url_string, verify=False)
-    data = resp.json()
-    print('    Number of requests: {}'.format(1))
+    features = query_features(base_url, where="(YEAR_ = 2022 OR YEAR_ = 9999)", out_sr=4326, f="json")
     
     print("    Processing data...")
-    fires = process_fire_data(data)
+    fires = process_fire_data({'features': features})
     end = time.perf_counter()
     print(f'\n    Finished in {round(end - start, 2)} second(s)')
     return fires
@@ -82,102 +85,64 @@ def get_fire_data():
 def fetch_all_features(base_url):
     start = time.perf_counter()
     
-    # Get record extract limit
-    url_string = base_url + "?f=json"
-    j = urllib.request.urlopen(url_string)
-    js = json.load(j)
-    max_records_count = int(js["maxRecordCount"])
-    max_records_count = min(max_records_count, 800)
-    
-    # Get object ids of features
-    fields = "*"
-    where = "1=1"
-    url_string = base_url + "/query?where={}&returnIdsOnly=true&f=json".format(where)
-    j = urllib.request.urlopen(url_string)
-    js = json.load(j)
-    id_field = js["objectIdFieldName"]
-    id_list = js["objectIds"]
-    id_list.sort()
-    num_of_records = len(id_list)
-    print(("\n    Number of target records: %s" % num_of_records))
-    
     print("    Gathering records…")
-    features_list = []
-    
-    def load_features(urlstring, return_dict):
-        succeed = False
-        while not succeed:
-            try:
-                resp = requests.get(urlstring, verify=False)
-                data = resp.json()
-                gdf = gpd.GeoDataFrame.from_features(data['features'], crs='EPSG:4269')
-                gdf = gdf.loc[gdf['geometry'].is_valid, :]
-                return_dict[urlstring] = gdf
-                succeed = True
-            except:
-                print ('Failed to load {}'.format(urlstring))
-    processes = []
-    manager = mp.Manager()
-    return_dict = manager.dict()
-    request_number = 0
-    for i in range(0, num_of_records, max_records_count):
-        request_number += 1
-        to_rec = i + (max_records_count - 1)
-        if to_rec > num_of_records:
-            to_rec = num_of_records - 1
-        from_id = id_list[i]
-        to_id = id_list[to_rec]
-        where = "{} >= {} and {} <= {}".format(id_field, from_id, id_field, to_id)
-        #print("  {}: {}".format(request_number, where))
-        url_string = base_url + "/query?where={}&returnGeometry=true&outFields={}&f=geojson".format(where, fields)
-    
-        p = mp.Process(target=load_features, args=[url_string, return_dict])
-        p.start()
-        processes.append(p)
-    
-    for p in processes:
-        p.join()
-    p.close()
-    
-    for url in return_dict.keys():
-        features_list.append(return_dict[url])
-    treats = pd.concat(features_list)
-    treats['activity_end'] = [datetime.datetime.fromtimestamp(ms/1000.0) for ms in treats['activity_end']]
+    features = query_features(base_url, f="geojson")
+    treats = gpd.GeoDataFrame.from_features(features, crs='EPSG:4269')
+    treats = treats.loc[treats['geometry'].is_valid, :]
+    treats['activity_end'] = pd.to_datetime(treats['activity_end'], unit='ms')
     treats = treats.set_index('globalid')
     treats = treats.to_crs(32611)
     end = time.perf_counter()
     print(f'    Finished in in {round(end - start, 2)} second(s)')
     return treats
 
-def get_bbox(poly):
-    envelope = poly.GetEnvelope()
-    min_x, max_x, min_y, max_y = envelope
-    ring = ogr.Geometry(ogr.wkbLinearRing)
-    ring.AddPoint(min_x, min_y)
-    ring.AddPoint(min_x, max_y)
-    ring.AddPoint(max_x, max_y)
-    ring.AddPoint(max_x, min_y)
-    ring.AddPoint(min_x, min_y)  # Close the ring
-    bbox_poly = ogr.Geometry(ogr.wkbPolygon)
-    bbox_poly.AddGeometry(ring)
-    return bbox_poly
-    
-def get_feature_intersections(objectid, fire_bbox, fire_poly, treatments, add_buffer, buffer_distance=20):
+def get_buffered_geoms(treat_table, buffer_distance=BUFFER_DISTANCE):
+    """
+    buffers every treatment geometry by `buffer_distance`, once per layer
+    results are saved under BUFFER_CACHE_DIR keyed by a hash of the
+    layer's globalids, geometries and the buffer parameters, so reruns on
+    unchanged layers load them instead of buffering again
+    """
+    geoms = np.asarray(treat_table.geometry)
+    key = geometry_hash(treat_table.index, geoms, buffer_distance, BUFFER_QUAD_SEGS)
+    cache_fp = BUFFER_CACHE_DIR + key + ".npz"
+    if os.path.exists(cache_fp):
+        return load_wkb(cache_fp)
+    buffered = shapely.buffer(geoms, buffer_distance, quad_segs=BUFFER_QUAD_SEGS)
+    os.makedirs(BUFFER_CACHE_DIR, exist_ok=True)
+    save_wkb(cache_fp, buffered)
+    return buffered
+
+def get_valid_prefix(activity_end, alarm_date):
+    """
+    treatment layers are sorted by activity_end, so the treatments that
+    ended before `alarm_date` are exactly the first `cutoff` rows
+    """
+    alarm_date = pd.Timestamp(alarm_date)
+    if pd.isna(alarm_date):
+        return 0
+    return np.searchsorted(activity_end, alarm_date.to_datetime64(), side='left')
+
+def get_candidates(fire_geom, alarm_date, item):
+    """
+    positions of treatments in `item` whose envelope overlaps the fire and
+    that ended before it started
+    """
+    candidates = item['tree'].query(fire_geom)
+    return candidates[candidates < get_valid_prefix(item['activity_end'], alarm_date)]
+
+def get_feature_intersections(objectid, fire_poly, treat_ids, treat_geoms):
     intersection_ids = []
     intersection_geoms = []
-    for treat_id, treat_row in treatments.iterrows():
-        treat_poly = ogr.CreateGeometryFromWkt(treat_row['geometry'].wkt)
-        if add_buffer:
-            treat_poly = treat_poly.Buffer(buffer_distance)  
-        treat_bbox = get_bbox(treat_poly)
-        if treat_bbox.Intersects(fire_bbox):
-            if treat_poly.Intersects(fire_poly):
-                intersection_geom = treat_poly.Intersection(fire_poly)
-                # 'ERROR 1: Empty Geometry Cannot Be Constructed' or something
-                # try/except did prevent ^that^ error, trying this instead
-                if intersection_geom and not intersection_geom.IsEmpty():
-                    intersection_geoms.append(intersection_geom.ExportToWkt())
-                    intersection_ids.append(treat_id)
+    for treat_id, treat_geom in zip(treat_ids, treat_geoms):
+        treat_poly = ogr.CreateGeometryFromWkt(treat_geom.wkt)
+        if treat_poly.Intersects(fire_poly):
+            intersection_geom = treat_poly.Intersection(fire_poly)
+            # 'ERROR 1: Empty Geometry Cannot Be Constructed' or something
+            # try/except did prevent ^that^ error, trying this instead
+            if intersection_geom and not intersection_geom.IsEmpty():
+                intersection_geoms.append(intersection_geom.ExportToWkt())
+                intersection_ids.append(treat_id)
 
     # issues saving geometry objects to file with GeoDataFrame
     # using DataFrame and saving WKT string instead
@@ -193,21 +158,272 @@ def get_all_intersections(objectid):
     fire = fires.loc[objectid]
     alarm_date = fire['alarm_date']
     fire_poly = ogr.CreateGeometryFromWkt(fire['geometry'].wkt)
-    fire_bbox = get_bbox(fire_poly)
     int_dfs = []
     for item in TREAT_DICT:
-        treat_table = item['table']
-        add_buffer = item['add_buffer']
-        treats_valid_date = treat_table[treat_table['activity_end'] < alarm_date]
-        int_dfs.append(get_feature_intersections(objectid, fire_bbox, fire_poly, treats_valid_date, add_buffer))
+        candidates = get_candidates(fire['geometry'], alarm_date, item)
+        int_dfs.append(get_feature_intersections(objectid, fire_poly, 
+                                                 item['table'].index.values[candidates], 
+                                                 item['geoms'][candidates]))
     all_int_df = pd.concat(int_dfs)
+    all_int_df['geometry'] = shapely.from_wkt(all_int_df['geometry'].values)
     all_int_df['fire_objectid'] = objectid
     return all_int_df
 
+def get_layer_intersections(fire_geom, alarm_date, item):
+    """
+    vectorized counterpart of get_feature_intersections: the candidate
+    treatments stay shapely geometries and are tested against the fire in
+    one call per predicate
+    returns the intersecting treatments' globalids and the intersections
+    """
+    candidates = get_candidates(fire_geom, alarm_date, item)
+    positions, intersection_geoms = intersect_candidates(fire_geom, candidates, item['geoms'][candidates])
+    return item['table'].index.values[positions], intersection_geoms
+
+def intersect_candidates(fire_geom, candidates, treat_geoms):
+    """
+    returns the positions in `candidates` of the treatments that intersect
+    the fire, and the non-empty intersections
+    """
+    hits = shapely.intersects(treat_geoms, fire_geom)
+    intersection_geoms = shapely.intersection(treat_geoms[hits], fire_geom)
+    not_empty = ~shapely.is_empty(intersection_geoms)
+    return candidates[hits][not_empty], intersection_geoms[not_empty]
+
+def get_all_intersections_vectorized(objectid):
+    fire = fires.loc[objectid]
+    fire_geom = fire['geometry']
+    shapely.prepare(fire_geom)
+    intersection_ids = []
+    intersection_geoms = []
+    for item in TREAT_DICT:
+        layer_ids, layer_geoms = get_layer_intersections(fire_geom, fire['alarm_date'], item)
+        intersection_ids.append(layer_ids)
+        intersection_geoms.append(layer_geoms)
+    all_int_df = pd.DataFrame({'treat_globalid': np.concatenate(intersection_ids),
+                               'geometry': np.concatenate(intersection_geoms)})
+    all_int_df['fire_objectid'] = objectid
+    return all_int_df
+
+def pack_layer(geoms, activity_end):
+    """
+    the arrays a worker needs for one treatment layer: WKB, envelopes for
+    the spatial index, and the sorted end dates
+    """
+    wkb_data, wkb_offsets = pack_wkb(geoms)
+    return {'wkb_data': wkb_data,
+            'wkb_offsets': wkb_offsets,
+            'bounds': shapely.bounds(geoms),
+            'activity_end': activity_end.astype('datetime64[ns]')}
+
+def init_shared_worker(fire_spec, layer_specs):
+    """
+    attaches the shared fire and treatment arrays and builds one STRtree per
+    layer from the envelopes, geometries are only decoded when queried
+    """
+    global SHARED_BLOCKS, FIRE_ARRAYS, LAYER_ARRAYS, LAYER_TREES
+    SHARED_BLOCKS, FIRE_ARRAYS = attach_arrays(fire_spec)
+    LAYER_ARRAYS = []
+    LAYER_TREES = []
+    for spec in layer_specs:
+        blocks, arrays = attach_arrays(spec)
+        SHARED_BLOCKS += blocks
+        LAYER_ARRAYS.append(arrays)
+        LAYER_TREES.append(STRtree(shapely.box(*arrays['bounds'].T)))
+
+def get_chunk_intersections(chunk):
+    """
+    intersects fires chunk[0]:chunk[1] (positions in the fire arrays) with
+    every treatment layer
+    returns one columnar batch: fire positions, layer numbers, treatment
+    positions within the (sorted) layer, and the intersections as packed WKB
+    """
+    start, stop = chunk
+    fire_geoms = unpack_wkb(FIRE_ARRAYS['wkb_data'], FIRE_ARRAYS['wkb_offsets'], range(start, stop))
+    fire_positions = []
+    layers = []
+    treat_positions = []
+    intersection_geoms = []
+    for fire_position, fire_geom in zip(range(start, stop), fire_geoms):
+        shapely.prepare(fire_geom)
+        alarm_date = FIRE_ARRAYS['alarm_date'][fire_position]
+        for layer, (arrays, tree) in enumerate(zip(LAYER_ARRAYS, LAYER_TREES)):
+            candidates = tree.query(fire_geom)
+            candidates = candidates[candidates < get_valid_prefix(arrays['activity_end'], alarm_date)]
+            treat_geoms = unpack_wkb(arrays['wkb_data'], arrays['wkb_offsets'], candidates)
+            positions, geoms = intersect_candidates(fire_geom, candidates, treat_geoms)
+            fire_positions.append(np.full(len(positions), fire_position, dtype=np.int64))
+            layers.append(np.full(len(positions), layer, dtype=np.int8))
+            treat_positions.append(positions.astype(np.int64))
+            intersection_geoms.append(geoms)
+    wkb_data, wkb_offsets = pack_wkb(np.concatenate(intersection_geoms))
+    return {'fire_position': np.concatenate(fire_positions),
+            'layer': np.concatenate(layers),
+            'treat_position': np.concatenate(treat_positions),
+            'wkb_data': wkb_data,
+            'wkb_offsets': wkb_offsets}
+
+def batch_to_frame(batch, treat_tables):
+    """
+    turns a batch from get_chunk_intersections back into rows with
+    globalids, objectids and geometries, like the per-fire functions return
+    """
+    treat_globalid = np.empty(len(batch['layer']), dtype=object)
+    for layer, treat_table in enumerate(treat_tables):
+        in_layer = batch['layer'] == layer
+        treat_globalid[in_layer] = treat_table.index.values[batch['treat_position'][in_layer]]
+    geoms = unpack_wkb(batch['wkb_data'], batch['wkb_offsets'])
+    return pd.DataFrame({'treat_globalid': treat_globalid,
+                         'geometry': geoms,
+                         'fire_objectid': fires.index.values[batch['fire_position']]})
+
+def get_intersections_shared(treat_tables, treat_geoms, processes=None):
+    """
+    runs get_chunk_intersections over every fire on a pool whose workers
+    read the geometries from shared memory, yielding one DataFrame per
+    chunk as it finishes
+    """
+    fire_geoms = np.asarray(fires.geometry)
+    fire_data, fire_offsets = pack_wkb(fire_geoms)
+    blocks, fire_spec = share_arrays({'wkb_data': fire_data,
+                                      'wkb_offsets': fire_offsets,
+                                      'alarm_date': fires['alarm_date'].values.astype('datetime64[ns]')})
+    layer_specs = []
+    try:
+        for treat_table, geoms in zip(treat_tables, treat_geoms):
+            layer_blocks, spec = share_arrays(pack_layer(geoms, treat_table['activity_end'].values))
+            blocks += layer_blocks
+            layer_specs.append(spec)
+        chunks = [(start, min(start + FIRE_CHUNK_SIZE, len(fire_geoms)))
+                  for start in range(0, len(fire_geoms), FIRE_CHUNK_SIZE)]
+        with mp.Pool(processes or mp.cpu_count(), initializer=init_shared_worker,
+                     initargs=(fire_spec, layer_specs)) as p:
+            batches = tqdm.tqdm(p.imap_unordered(get_chunk_intersections, chunks), total=len(chunks))
+            for batch in batches:
+                yield batch_to_frame(batch, treat_tables)
+    finally:
+        release(blocks)
+
+def open_output(fp, out_format, crs_wkt):
+    """
+    creates (replacing) the results file and returns the state that
+    append_output and close_output work on
+    """
+    if os.path.exists(fp):
+        os.remove(fp)
+    output = {'fp': fp, 'format': out_format, 'rows': 0}
+    if out_format == 'FlatGeobuf':
+        output['ds'] = ogr.GetDriverByName('FlatGeobuf').CreateDataSource(fp)
+        output['layer'] = output['ds'].CreateLayer('intersections', osr.SpatialReference(wkt=crs_wkt), ogr.wkbUnknown)
+        output['layer'].CreateField(ogr.FieldDefn('treat_globalid', ogr.OFTString))
+        output['layer'].CreateField(ogr.FieldDefn('fire_objectid', ogr.OFTInteger64))
+    elif out_format != 'CSV':
+        raise ValueError(f"unsupported output format {out_format}")
+    return output
+
+def append_output(output, int_df):
+    """
+    appends one DataFrame of intersections, so only the current batch is
+    ever held in memory
+    """
+    # the csv header goes out with the first non-empty batch
+    if len(int_df) == 0:
+        return
+    if output['format'] == 'CSV':
+        int_df = int_df.assign(geometry=shapely.to_wkt(int_df['geometry'].values, rounding_precision=-1))
+        int_df.index = pd.RangeIndex(output['rows'], output['rows'] + len(int_df))
+        int_df.to_csv(output['fp'], mode='a', header=output['rows'] == 0)
+    else:
+        layer = output['layer']
+        layer_defn = layer.GetLayerDefn()
+        for treat_globalid, fire_objectid, wkb in zip(int_df['treat_globalid'], int_df['fire_objectid'],
+                                                      shapely.to_wkb(int_df['geometry'].values)):
+            feature = ogr.Feature(layer_defn)
+            feature.SetField('treat_globalid', str(treat_globalid))
+            feature.SetField('fire_objectid', int(fire_objectid))
+            feature.SetGeometry(ogr.CreateGeometryFromWkb(wkb))
+            layer.CreateFeature(feature)
+    output['rows'] += len(int_df)
+
+def close_output(output):
+    """
+    FlatGeobuf writes its spatial index when the dataset is closed, a csv
+    without any intersections still gets its header
+    """
+    if output['format'] == 'FlatGeobuf':
+        output['layer'] = None
+        output['ds'] = None
+    elif output['rows'] == 0:
+        pd.DataFrame(columns=['treat_globalid', 'geometry', 'fire_objectid']).to_csv(output['fp'])
+
+def compute_intersections(fire_table, treat_tables, treat_geoms):
+    """
+    intersects every fire in `fire_table` with the treatment layers,
+    yielding DataFrames of results as the workers finish
+    """
+    global fires
+    fires = fire_table
+    if SHARED_MEMORY:
+        yield from get_intersections_shared(treat_tables, treat_geoms)
+        return
+    global TREAT_DICT
+    # bulk-load one spatial index per treatment layer, inherited by the workers
+    TREAT_DICT = []
+    for treat_table, geoms in zip(treat_tables, treat_geoms):
+        TREAT_DICT.append({'table': treat_table, 
+                           'geoms': geoms,
+                           'activity_end': treat_table['activity_end'].values.astype('datetime64[ns]'),
+                           'tree': STRtree(geoms)})
+    with mp.Pool(mp.cpu_count()) as p:
+        intersection_func = get_all_intersections_vectorized if VECTORIZED else get_all_intersections
+        yield from tqdm.tqdm(p.imap_unordered(intersection_func, fires.index), total=len(fires.index))
+        #results = p.map(get_all_intersections, fires.index)
+
+def update_store(conn, fire_table, treat_tables, treat_geoms, buffer_distances):
+    """
+    brings the result store up to date with the current fires and treatments
+     - fires that are new or changed are intersected with every treatment
+     - the remaining fires are intersected with new or changed treatments
+     - results involving removed features are dropped
+    a treatment's hash covers its raw geometry, end date and buffer distance
+    """
+    fire_hashes = dict(zip(fire_table.index.tolist(),
+                           feature_hashes(np.asarray(fire_table.geometry),
+                                          fire_table['alarm_date'].values.astype('datetime64[ns]'))))
+    treat_hashes = {}
+    for treat_table, buffer_distance in zip(treat_tables, buffer_distances):
+        treat_hashes.update(zip(treat_table.index.tolist(),
+                                feature_hashes(np.asarray(treat_table.geometry), treat_table['activity_end'].values.astype('datetime64[ns]'),
+                                               [(buffer_distance, BUFFER_QUAD_SEGS)] * len(treat_table))))
+    changed_fires, removed_fires = intersection_store.diff_features(conn, 'fires', fire_hashes)
+    changed_treats, removed_treats = intersection_store.diff_features(conn, 'treatments', treat_hashes)
+    print(f"{len(changed_fires)} new or changed fires, {len(removed_fires)} removed")
+    print(f"{len(changed_treats)} new or changed treatments, {len(removed_treats)} removed")
+
+    intersection_store.remove_stale(conn, changed_fires + removed_fires, changed_treats + removed_treats)
+    is_changed_fire = fire_table.index.isin(changed_fires)
+    changed_treat_tables = []
+    changed_treat_geoms = []
+    for treat_table, geoms in zip(treat_tables, treat_geoms):
+        # boolean masks keep the activity_end order
+        is_changed_treat = treat_table.index.isin(changed_treats)
+        changed_treat_tables.append(treat_table[is_changed_treat])
+        changed_treat_geoms.append(geoms[is_changed_treat])
+    runs = [(fire_table[is_changed_fire], treat_tables, treat_geoms),
+            (fire_table[~is_changed_fire], changed_treat_tables, changed_treat_geoms)]
+    for run_fires, run_tables, run_geoms in runs:
+        if len(run_fires) == 0 or sum(len(table) for table in run_tables) == 0:
+            continue
+        for int_df in compute_intersections(run_fires, run_tables, run_geoms):
+            intersection_store.add_intersections(conn, int_df)
+    intersection_store.record_features(conn, 'fires', fire_hashes, changed_fires, removed_fires)
+    intersection_store.record_features(conn, 'treatments', treat_hashes, changed_treats, removed_treats)
+    # one transaction, an interrupted run leaves the previous results intact
+    conn.commit()
+
 def main():
     print("getting fire data...")
-    global fires
-    fires = get_fire_data()
+    fire_table = get_fire_data()
 
     print("\ngetting treatment data...")
     TREAT_URLS = ["https://gsal.sig-gis.com/server/rest/services/Hosted/ITS_Dashboard_Feature_Layer/FeatureServer/0", 
@@ -217,26 +433,28 @@ def main():
                   True, 
                   False]
     TREAT_TABLES = [fetch_all_features(url) for url in TREAT_URLS]
-    global TREAT_DICT
-    TREAT_DICT = [{'table': TREAT_TABLES[i], 'add_buffer': ADD_BUFFER[i]} for i in range(len(TREAT_URLS))]
+    # sorted by activity_end so each fire's date filter is a binary search
+    TREAT_TABLES = [table.sort_values('activity_end', kind='stable') for table in TREAT_TABLES]
+    # buffered once per layer, the trees index the buffered envelopes
+    TREAT_GEOMS = [get_buffered_geoms(table) if add_buffer else np.asarray(table.geometry)
+                   for table, add_buffer in zip(TREAT_TABLES, ADD_BUFFER)]
 
     print(f"\n{mp.cpu_count()} cores available")
     print("finding intersecions...", "\n")
-    with mp.Pool(mp.cpu_count()) as p:
-        results = [_ for _ in tqdm.tqdm(p.imap_unordered(get_all_intersections, fires.index), total=len(fires.index))]
-        #results = p.map(get_all_intersections, fires.index)
-
-    print("\nsaving data to file...")
-    #issues saving as GeoDataFrame, using DataFrame instead
-    all_data_df = pd.concat(results, ignore_index=True)
-    #all_data_df = gpd.GeoDataFrame(pd.concat(results,ignore_index=True))
-    #convert from OGR to Shapely Geometry objects [since Geopandas uses Shapely objects]
-    #all_data_df['geometry'] = all_data_df['geometry'].apply(lambda wkt_string: wkt.loads(wkt_string))
-    #all_data_df.set_geometry('geometry')
-    all_data_df.to_csv(OUT_FILENAME)
-    print(f"successfully saved to {OUT_FILENAME}")
+    output = open_output(OUT_FILENAME, OUT_FORMAT, fire_table.crs.to_wkt())
+    if INCREMENTAL:
+        conn = intersection_store.open_store(STORE_FP)
+        buffer_distances = [BUFFER_DISTANCE if add_buffer else None for add_buffer in ADD_BUFFER]
+        update_store(conn, fire_table, TREAT_TABLES, TREAT_GEOMS, buffer_distances)
+        results = intersection_store.iter_intersections(conn)
+    else:
+        results = compute_intersections(fire_table, TREAT_TABLES, TREAT_GEOMS)
+    for int_df in results:
+        append_output(output, int_df)
+    close_output(output)
+    print(f"successfully saved {output['rows']} intersections to {OUT_FILENAME}")
 
     print('\nwith love, from ozan')
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,87 @@
+import sqlite3
+import pandas as pd
+import shapely
+
+# results of earlier runs: the hash of every fire and treatment they were
+# computed from, and the intersections themselves as WKB
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fires (
+    objectid        INTEGER PRIMARY KEY,
+    hash            TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS treatments (
+    globalid        TEXT PRIMARY KEY,
+    hash            TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS intersections (
+    fire_objectid   INTEGER NOT NULL,
+    treat_globalid  TEXT NOT NULL,
+    geometry        BLOB NOT NULL,
+    PRIMARY KEY (fire_objectid, treat_globalid)
+);
+CREATE INDEX IF NOT EXISTS intersections_treat ON intersections (treat_globalid);
+"""
+# primary key column of the fires and treatments tables
+KEY_COLUMNS = {'fires': 'objectid', 'treatments': 'globalid'}
+
+def open_store(store_fp: str):
+    """
+    opens (creating if needed) the sqlite result store at `store_fp`
+    """
+    conn = sqlite3.connect(store_fp)
+    conn.executescript(SCHEMA)
+    conn.commit()
+    return conn
+
+def diff_features(conn, table: str, hashes: dict):
+    """
+    compares {key: hash} for the current features against `table`
+    returns (changed, removed): keys that are new or whose hash differs,
+    and stored keys that no longer exist
+    """
+    stored = dict(conn.execute(f"SELECT {KEY_COLUMNS[table]}, hash FROM {table}").fetchall())
+    changed = [key for key, h in hashes.items() if stored.get(key) != h]
+    removed = [key for key in stored if key not in hashes]
+    return changed, removed
+
+def remove_stale(conn, fire_objectids, treat_globalids):
+    """
+    drops every stored intersection involving one of the given fires or
+    treatments, they are recomputed or gone
+    """
+    conn.executemany("DELETE FROM intersections WHERE fire_objectid = ?",
+                     [(int(objectid),) for objectid in fire_objectids])
+    conn.executemany("DELETE FROM intersections WHERE treat_globalid = ?",
+                     [(str(globalid),) for globalid in treat_globalids])
+
+def add_intersections(conn, int_df):
+    """
+    stores a DataFrame of intersections as returned by get_intersections
+    """
+    conn.executemany("INSERT OR REPLACE INTO intersections VALUES (?, ?, ?)",
+                     zip(map(int, int_df['fire_objectid']), map(str, int_df['treat_globalid']),
+                         shapely.to_wkb(int_df['geometry'].values)))
+
+def record_features(conn, table: str, hashes: dict, changed, removed):
+    """
+    updates `table` to the current hashes of the changed features and
+    forgets the removed ones
+    """
+    key_column = KEY_COLUMNS[table]
+    conn.executemany(f"DELETE FROM {table} WHERE {key_column} = ?", [(key,) for key in removed])
+    conn.executemany(f"INSERT OR REPLACE INTO {table} VALUES (?, ?)", [(key, hashes[key]) for key in changed])
+
+def iter_intersections(conn, batch_size=100000):
+    """
+    yields every stored intersection as DataFrames of at most `batch_size`
+    rows, with the same columns get_intersections returns
+    """
+    cursor = conn.execute("SELECT treat_globalid, geometry, fire_objectid FROM intersections")
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        treat_globalids, wkbs, fire_objectids = zip(*rows)
+        yield pd.DataFrame({'treat_globalid': treat_globalids,
+                            'geometry': shapely.from_wkb(list(wkbs)),
+                            'fire_objectid': fire_objectids})
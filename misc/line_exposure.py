@@ -0,0 +1,140 @@
+import sys
+import time
+import numpy as np
+import geopandas as gpd
+import shapely
+from shapely import STRtree
+
+# ignition exposure along utility lines: every line is split into segments
+# of at most SEGMENT_LENGTH and the ignitions within each corridor
+# distance of a segment are counted
+#  - distances are in the units of CRS (meters for EPSG:5070)
+#  - the spatial index is queried once at the largest distance, other
+#    distances only filter the candidate pairs, so rerunning with new
+#    distances up to that maximum is cheap
+DATA_DIR = "../data/sierra_nevada/"
+IGNITIONS_FP = DATA_DIR + "sierra_nevada_fire_ignitions.geojson"
+LINES_FP = DATA_DIR + "sierra_nevada_utility_lines.geojson"
+OUT_FILENAME = "line_exposure.gpkg"
+CRS = "EPSG:5070"
+SEGMENT_LENGTH = 1000
+DISTANCES = [500, 1000, 2000, 5000]
+LINE_COLUMNS = ['OBJECTID', 'Line_Name', 'VOLTAGE', 'VOLT_CLASS', 'STATUS']
+
+def load_layer(fp, crs=CRS):
+    """
+    reads a vector layer in `crs`, without empty geometries
+    """
+    gdf = gpd.read_file(fp)
+    if gdf.crs != crs:
+        gdf = gdf.to_crs(crs)
+    return gdf.loc[~(gdf.geometry.is_empty | gdf.geometry.isna())]
+
+def segment_lines(lines, segment_length=SEGMENT_LENGTH):
+    """
+    splits every (multi)line into consecutive pieces of at most
+    `segment_length`, with array operations over all vertices at once
+    input:  lines           GeoDataFrame
+    output: segments        GeoDataFrame    one row per piece: the source
+                                            row's attributes, `segment`
+                                            (its position along the line,
+                                            counted on through the parts
+                                            of a multiline) and `length`
+    """
+    # explode keeps the parts of a line together and in order
+    line_position = np.repeat(np.arange(len(lines)), np.maximum(shapely.get_num_geometries(np.asarray(lines.geometry)), 1))
+    parts = lines.explode(index_parts=False)
+    geoms = np.asarray(parts.geometry)
+    coords, part_index = shapely.get_coordinates(geoms, return_index=True)
+
+    # distance of every vertex along its part
+    steps = np.r_[0, np.hypot(*np.diff(coords, axis=0).T)]
+    starts = np.flatnonzero(np.r_[True, part_index[1:] != part_index[:-1]])
+    steps[starts] = 0
+    distance = np.cumsum(steps)
+    distance -= np.repeat(distance[starts], np.diff(np.r_[starts, len(distance)]))
+
+    lengths = shapely.length(geoms)
+    segment_counts = np.maximum(np.ceil(lengths / segment_length).astype(np.int64), 1)
+    vertex_segment = np.minimum((distance // segment_length).astype(np.int64), segment_counts[part_index] - 1)
+
+    # cut points at every multiple of segment_length, each one ends a
+    # piece and starts the next
+    cut_counts = segment_counts - 1
+    cut_part = np.repeat(np.arange(len(geoms)), cut_counts)
+    cut_number = np.arange(len(cut_part)) - np.repeat(np.cumsum(cut_counts) - cut_counts, cut_counts) + 1
+    cut_distance = cut_number * float(segment_length)
+    cut_coords = shapely.get_coordinates(shapely.line_interpolate_point(geoms[cut_part], cut_distance))
+
+    all_part = np.concatenate([part_index, cut_part, cut_part])
+    all_segment = np.concatenate([vertex_segment, cut_number - 1, cut_number])
+    all_distance = np.concatenate([distance, cut_distance, cut_distance])
+    all_coords = np.concatenate([coords, cut_coords, cut_coords])
+    order = np.lexsort((all_distance, all_segment, all_part))
+    segment_offsets = np.cumsum(segment_counts) - segment_counts
+    segment_index = segment_offsets[all_part[order]] + all_segment[order]
+    segment_geoms = shapely.linestrings(all_coords[order], indices=segment_index)
+
+    segment_part = np.repeat(np.arange(len(geoms)), segment_counts)
+    segments = parts.drop(columns=parts.geometry.name).iloc[segment_part]
+    segments = gpd.GeoDataFrame(segments.reset_index(names='line_index'), geometry=segment_geoms, crs=lines.crs)
+    segment_line = line_position[segment_part]
+    line_starts = np.flatnonzero(np.r_[True, segment_line[1:] != segment_line[:-1]])
+    segments['segment'] = np.arange(len(segments)) - np.repeat(line_starts, np.diff(np.r_[line_starts, len(segments)]))
+    segments['length'] = shapely.length(segment_geoms)
+    return segments
+
+def get_candidate_pairs(segments, ignitions, max_distance):
+    """
+    every (segment, ignition) pair within `max_distance`, found with one
+    bulk STRtree query
+    output: segment_index, ignition_index, distance     numpy arrays
+    """
+    ignition_geoms = np.asarray(ignitions.geometry)
+    segment_geoms = np.asarray(segments.geometry)
+    tree = STRtree(ignition_geoms)
+    segment_index, ignition_index = tree.query(segment_geoms, predicate='dwithin', distance=max_distance)
+    distance = shapely.distance(segment_geoms[segment_index], ignition_geoms[ignition_index])
+    return segment_index, ignition_index, distance
+
+def get_exposure(segments, pairs, distances=DISTANCES):
+    """
+    adds, per distance d, `ignitions_<d>` (ignitions within d of the
+    segment) and `density_<d>` (per km² of corridor) to a copy of `segments`
+    the corridor area 2 * d * length + pi * d² is exact for straight segments
+    """
+    segment_index, _, pair_distance = pairs
+    exposure = segments.copy()
+    for distance in distances:
+        counts = np.bincount(segment_index[pair_distance <= distance], minlength=len(segments))
+        area_km2 = (2 * distance * exposure['length'].values + np.pi * distance ** 2) / 1e6
+        exposure[f'ignitions_{distance}'] = counts
+        exposure[f'density_{distance}'] = counts / area_km2
+    return exposure
+
+def main():
+    # e.g. `python line_exposure.py 250 500 1000`
+    distances = [int(arg) for arg in sys.argv[1:]] or DISTANCES
+    start = time.perf_counter()
+    print("loading layers...")
+    lines = load_layer(LINES_FP)
+    lines = lines[[col for col in LINE_COLUMNS if col in lines.columns] + [lines.geometry.name]]
+    ignitions = load_layer(IGNITIONS_FP)
+    print(f"    {len(lines)} lines, {len(ignitions)} ignitions")
+
+    print(f"splitting lines into {SEGMENT_LENGTH} m segments...")
+    segments = segment_lines(lines, SEGMENT_LENGTH)
+    print(f"    {len(segments)} segments")
+
+    print(f"counting ignitions within {', '.join(map(str, distances))} m...")
+    pairs = get_candidate_pairs(segments, ignitions, max(distances))
+    exposure = get_exposure(segments, pairs, distances)
+
+    exposure.to_file(OUT_FILENAME, driver='GPKG')
+    end = time.perf_counter()
+    print(f"successfully saved to {OUT_FILENAME} in {round(end - start, 2)} second(s)")
+
+    print('\nwith love, from ozan')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+import numpy as np
+from multiprocessing import shared_memory
+
+def share_arrays(arrays):
+    """
+    copies every numpy array in `arrays` ({name: array}) into its own
+    shared memory block
+    returns (blocks, spec): the parent keeps `blocks` alive and passes them to
+    `release` when done, workers pass the small picklable `spec` to
+    `attach_arrays`
+    """
+    blocks = []
+    spec = {}
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        # zero sized blocks are not allowed
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+        blocks.append(block)
+        spec[name] = (block.name, array.shape, array.dtype.str)
+    return blocks, spec
+
+def attach_arrays(spec):
+    """
+    maps the blocks described by `spec` without copying them
+    returns (blocks, arrays): `blocks` must stay referenced for as long as
+    the arrays are in use
+    """
+    blocks = []
+    arrays = {}
+    for name, (block_name, shape, dtype) in spec.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        arrays[name] = np.ndarray(shape, dtype, buffer=block.buf)
+        blocks.append(block)
+    return blocks, arrays
+
+def release(blocks):
+    """
+    frees blocks created by `share_arrays`, call once from the parent
+    """
+    for block in blocks:
+        block.close()
+        block.unlink()
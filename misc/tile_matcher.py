@@ -0,0 +1,79 @@
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from shapely import STRtree
+import rasterio
+from rasterio.warp import transform_bounds
+from concurrent.futures import ThreadPoolExecutor
+
+# matches transmission lines to the raster tiles (e.g. Landsat band files)
+# they cross, replacing the nested bounds-against-tiles loop in
+# intersection_lister.ipynb
+#  - tile footprints come from the GeoTIFF headers, no pixels are read
+#  - the footprints are bulk-loaded into an STRtree that is queried with
+#    every line at once
+DATA_DIR = "./data/"
+TIF_DIR = DATA_DIR + "B5/"
+LINES_FP = "./Transmission_Line_1604355110918241857.geojson"
+OUT_FILENAME = "line_tile_matches.csv"
+TARGET_CRS = "EPSG:3857"
+MAX_THREADS = 16
+
+def read_footprint(tif_fp, dst_crs=TARGET_CRS):
+    """
+    the bounding box of a raster in `dst_crs`, from its header only
+    edges are densified so the box still covers the tile after
+    reprojecting between e.g. UTM and web mercator
+    """
+    with rasterio.open(tif_fp) as src:
+        return shapely.box(*transform_bounds(src.crs, dst_crs, *src.bounds, densify_pts=21))
+
+def build_footprint_index(tif_dir=TIF_DIR, dst_crs=TARGET_CRS, max_threads=MAX_THREADS):
+    """
+    reads the footprint of every .TIF in `tif_dir`
+    output: tile_names  numpy array     file names
+            footprints  numpy array     shapely boxes in `dst_crs`
+            tree        STRtree         over `footprints`
+    """
+    tile_names = np.array(sorted(name for name in os.listdir(tif_dir) if name.upper().endswith('.TIF')))
+    with ThreadPoolExecutor(max_workers=max_threads) as executor:
+        footprints = np.array(list(executor.map(lambda name: read_footprint(os.path.join(tif_dir, name), dst_crs),
+                                                tile_names)), dtype=object)
+    return tile_names, footprints, STRtree(footprints)
+
+def match_lines_to_tiles(lines, tile_names, tree, use_bounds=False):
+    """
+    every (line, tile) pair whose geometries intersect, in one bulk query
+    input:  lines       GeoDataFrame    in the footprints' CRS
+            use_bounds  bool            compare the lines' bounding boxes
+                                        instead of the lines, as the
+                                        notebook did
+    output: DataFrame with the line's index in `lines` and the tile's name
+    """
+    geoms = np.asarray(lines.geometry)
+    if use_bounds:
+        geoms = shapely.envelope(geoms)
+    line_index, tile_index = tree.query(geoms, predicate='intersects')
+    return pd.DataFrame({'line_index': lines.index.values[line_index],
+                         'tile': tile_names[tile_index]})
+
+def main():
+    lines_fp = sys.argv[1] if len(sys.argv) > 1 else LINES_FP
+    tif_dir = sys.argv[2] if len(sys.argv) > 2 else TIF_DIR
+    start = time.perf_counter()
+    lines = gpd.read_file(lines_fp).to_crs(TARGET_CRS)
+    tile_names, footprints, tree = build_footprint_index(tif_dir)
+    print(f"{len(lines)} lines, {len(tile_names)} tiles")
+    matches = match_lines_to_tiles(lines, tile_names, tree)
+    matches.to_csv(OUT_FILENAME, index=False)
+    end = time.perf_counter()
+    print(f"{len(matches)} line/tile matches saved to {OUT_FILENAME} in {round(end - start, 2)} second(s)")
+
+    print('\nwith love, from ozan')
+
+if __name__ == "__main__":
+    main()
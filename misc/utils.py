@@ -1,51 +1,341 @@
+import os
+import math
 import numpy as np
 import geopandas as gpd
+import shapely
 import rasterio
-from rasterio.features import rasterize
+from rasterio.features import rasterize, MergeAlg
+from rasterio.windows import Window, transform as window_transform
+from rasterio.errors import WindowError
+from rasterio.warp import reproject, transform_bounds, Resampling
+from scipy.signal import fftconvolve
 
 import requests
 import folium
 from folium.plugins import HeatMap
-from folium.raster_layers import ImageOverlay
+from folium.raster_layers import ImageOverlay, TileLayer
 
 import matplotlib.pyplot as plt
 from PIL import Image
+import shutil
 import tempfile
 
-from tqdm import tqdm
+from wkb_utils import geometry_hash
 
-def vector_to_heatmap_overlay(geoms, layer_name, aoi_geom):
-    ##TODO: adjust sampling resolution
-    sampling_resolution = 500
+# half the width of the web mercator world, in meters
+WEB_MERCATOR_ORIGIN = 20037508.342789244
+TILE_SIZE = 256
+# rows colorized at a time, bounds the float scratch memory
+COLORIZE_BLOCK_ROWS = 1024
+# rendered heatmaps, keyed by a hash of their inputs and evicted least
+# recently used first once they take more than HEATMAP_CACHE_MB
+HEATMAP_CACHE_DIR = "./data/heatmap_cache/"
+HEATMAP_CACHE_MB = 512
+# file in a tile directory recording the inputs its tiles were made from
+TILES_KEY_FILENAME = "heatmap.key"
+# kernels are cut off at this many bandwidths
+KDE_KERNEL_RADIUS = 4
+# densities below this fraction of the maximum are left transparent
+KDE_ALPHA_CUTOFF = 1e-3
+
+def burn_density(geoms, transform, out_shape, all_touched=True):
+    """
+    counts the geometries touching every pixel. single-part geometries are
+    burnt into one canvas in a single rasterize call. MergeAlg.add would
+    count every part of a multipart geometry, so those are rasterized one
+    at a time on their own window and added, a pixel covered by several
+    parts of the same geometry still counts once
+    """
+    geoms = np.asarray(list(geoms), dtype=object)
+    geoms = geoms[~(shapely.is_missing(geoms) | shapely.is_empty(geoms))]
+    data = np.zeros(out_shape, dtype=np.uint32)
+    # a collection can hold a multipart geometry as its only member
+    type_ids = shapely.get_type_id(geoms)
+    multipart = (type_ids == 7) | ((type_ids >= 4) & (shapely.get_num_geometries(geoms) > 1))
+    if (~multipart).any():
+        data += rasterize(shapes=[(geom, 1) for geom in geoms[~multipart]], fill=0, transform=transform,
+                          out_shape=out_shape, all_touched=all_touched, merge_alg=MergeAlg.add, dtype=np.uint32)
+    canvas = Window(0, 0, out_shape[1], out_shape[0])
+    for geom in geoms[multipart]:
+        minx, miny, maxx, maxy = geom.bounds
+        cols, rows = ~transform * (np.array([minx, maxx, minx, maxx]), np.array([miny, miny, maxy, maxy]))
+        # a pixel of margin, all_touched can burn pixels the bounds only graze
+        col_off, row_off = int(math.floor(cols.min())) - 1, int(math.floor(rows.min())) - 1
+        window = Window(col_off, row_off, int(math.ceil(cols.max())) + 1 - col_off, int(math.ceil(rows.max())) + 1 - row_off)
+        try:
+            window = window.intersection(canvas)
+        except WindowError:
+            continue
+        data[window.toslices()] += rasterize(shapes=[(geom, 1)], fill=0, transform=window_transform(window, transform),
+                                             out_shape=(window.height, window.width), all_touched=all_touched,
+                                             dtype=np.uint8)
+    return data
+
+def heatmap_key(geoms, *params):
+    """
+    sha256 over the geometries and every parameter that changes the image
+    """
+    geoms = np.asarray(list(geoms), dtype=object)
+    # missing geometries don't change the image
+    geoms = geoms[~shapely.is_missing(geoms)]
+    return geometry_hash(range(len(geoms)), geoms, *params)
+
+def evict_heatmaps(budget_bytes, keep_fp=None):
+    """
+    deletes the least recently used cached heatmaps until the cache fits in
+    `budget_bytes`, never `keep_fp`
+    """
+    entries = [entry for entry in os.scandir(HEATMAP_CACHE_DIR) if entry.is_file()]
+    total = sum(entry.stat().st_size for entry in entries)
+    for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+        if total <= budget_bytes:
+            break
+        if entry.path == keep_fp:
+            continue
+        total -= entry.stat().st_size
+        os.remove(entry.path)
+
+def save_heatmap(rgba, image_fp):
+    """
+    writes an RGBA array into the heatmap cache, then evicts
+    """
+    os.makedirs(HEATMAP_CACHE_DIR, exist_ok=True)
+    Image.fromarray(rgba, 'RGBA').save(image_fp + ".part", format='PNG')
+    os.replace(image_fp + ".part", image_fp)
+    evict_heatmaps(HEATMAP_CACHE_MB * 1024 * 1024, keep_fp=image_fp)
+
+def colorize(data, vmin, vmax, cmap_name='viridis'):
+    """
+    maps `data` to uint8 RGBA through a 256 color lookup table, block by
+    block, with pixels equal to 0 left transparent
+    """
+    lut = (plt.get_cmap(cmap_name)(np.linspace(0, 1, 256))[:, :3] * 255).astype(np.uint8)
+    scale = 256 / (vmax - vmin) if vmax > vmin else 0
+    rgba = np.zeros(data.shape + (4,), dtype=np.uint8)
+    for start in range(0, data.shape[0], COLORIZE_BLOCK_ROWS):
+        block = data[start:start + COLORIZE_BLOCK_ROWS]
+        index = np.clip((block.astype(np.float32) - vmin) * scale, 0, 255).astype(np.uint8)
+        rgba[start:start + COLORIZE_BLOCK_ROWS, :, :3] = lut[index]
+        rgba[start:start + COLORIZE_BLOCK_ROWS, :, 3] = np.where(block > 0, 255, 0)
+    return rgba
+
+def vector_to_heatmap_overlay(geoms, layer_name, aoi_geom, sampling_resolution=500):
+    """
+    renders the whole AOI into one PNG overlay, `sampling_resolution` is in
+    pixels per degree. for large AOIs use vector_to_heatmap_tiles
+    the PNG is kept in HEATMAP_CACHE_DIR, so unchanged layers are not
+    rendered again
+    """
+    geoms = list(geoms)
     minx, miny, maxx, maxy = aoi_geom.bounds
+    key = heatmap_key(geoms, aoi_geom.bounds, sampling_resolution, 'viridis')
+    image_fp = HEATMAP_CACHE_DIR + key + ".png"
+    if os.path.exists(image_fp):
+        # marks it as recently used
+        os.utime(image_fp)
+        return ImageOverlay(
+            name=layer_name,
+            image=image_fp,
+            bounds=[[miny, minx], [maxy, maxx]],
+            opacity=0.6
+        )
     width_raw = maxx - minx
     height_raw = maxy - miny
     width_adj = int(width_raw * sampling_resolution)
     height_adj = int(height_raw * sampling_resolution)
     # this does something?
     trans = rasterio.transform.from_bounds(minx, miny, maxx, maxy, width_adj, height_adj)
-    data = np.zeros((height_adj, width_adj))
     # get overlaps
-    for geom in tqdm(geoms):
-        rasterized_geom = rasterize(shapes=[(geom, 1)], fill=0, transform=trans, out_shape=(height_adj, width_adj), all_touched=True)
-        data += rasterized_geom
+    data = burn_density(geoms, trans, (height_adj, width_adj))
 
-    plt.imshow(data)
     # create image
-    cmap = plt.get_cmap('viridis')
-    norm = plt.Normalize(vmin=data.min(), vmax=data.max())
-    image_data = cmap(norm(data))
-    alpha_channel = np.where(data > 0, 255, 0)
-    rgba_image_data = np.dstack((image_data[:, :, :3] * 255, alpha_channel)).astype(np.uint8)
-    image = Image.fromarray(rgba_image_data, 'RGBA')
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.png') as tmp_file:
-        image.save(tmp_file.name, format='PNG')
-        tmp_file_path = tmp_file.name
+    rgba_image_data = colorize(data, data.min(), data.max())
+    save_heatmap(rgba_image_data, image_fp)
     # create layer
     img_overlay = ImageOverlay(
         name=layer_name,
-        image=tmp_file_path,
+        image=image_fp,
         bounds=[[miny, minx], [maxy, maxx]],
         opacity=0.6
     )
-    return img_overlay
\ No newline at end of file
+    return img_overlay
+
+def kde_surface(xy, bounds, cell_size, bandwidth, weights=None):
+    """
+    gaussian kernel density estimate on a regular grid: the points are
+    binned into counts, which are convolved with the kernel by FFT, so the
+    cost depends on the grid and kernel size, not the number of points
+    input:  xy          (n, 2) array    point coordinates in a projected CRS
+            bounds      tuple           (minx, miny, maxx, maxy) of the grid
+            cell_size   float           grid resolution, in CRS units
+            bandwidth   float           kernel standard deviation, in CRS units
+            weights     (n,) array      optional weight per point
+    output: density     2d array        points per square CRS unit at every
+                                        cell, first row at maxy
+            transform   Affine          of the grid
+    """
+    minx, miny, maxx, maxy = bounds
+    width = max(int(math.ceil((maxx - minx) / cell_size)), 1)
+    height = max(int(math.ceil((maxy - miny) / cell_size)), 1)
+    maxx, miny = minx + width * cell_size, maxy - height * cell_size
+    counts, _, _ = np.histogram2d(xy[:, 1], xy[:, 0], bins=[height, width],
+                                  range=[[miny, maxy], [minx, maxx]], weights=weights)
+    # histogram rows run south to north, rasters north to south
+    counts = counts[::-1]
+
+    radius = max(int(math.ceil(KDE_KERNEL_RADIUS * bandwidth / cell_size)), 1)
+    offsets = np.arange(-radius, radius + 1) * cell_size
+    kernel_1d = np.exp(-0.5 * (offsets / bandwidth) ** 2)
+    kernel = np.outer(kernel_1d, kernel_1d)
+    # normalized on the grid, so narrow kernels still keep every point's mass
+    kernel /= kernel.sum() * cell_size ** 2
+    density = np.maximum(fftconvolve(counts, kernel, mode='same'), 0)
+    transform = rasterio.transform.from_bounds(minx, miny, maxx, maxy, width, height)
+    return density, transform
+
+def vector_to_kde_overlay(geoms, layer_name, aoi_geom, bandwidth=5000, cell_size=500, crs='EPSG:5070'):
+    """
+    renders a kernel density surface of `geoms` (their centroids for lines
+    and polygons) over the AOI as a PNG overlay
+    input:  geoms, aoi_geom             in EPSG:4326, as for
+                                        vector_to_heatmap_overlay
+            bandwidth, cell_size float  in meters
+            crs                  str    equal-area CRS the density is
+                                        computed in
+    the surface is reprojected to web mercator so it lines up with the map
+    tiles, and cached like vector_to_heatmap_overlay
+    """
+    geoms = list(geoms)
+    key = heatmap_key(geoms, aoi_geom.bounds, 'kde', bandwidth, cell_size, crs, 'viridis')
+    image_fp = HEATMAP_CACHE_DIR + key + ".png"
+    west, south, east, north = transform_bounds('EPSG:3857', 'EPSG:4326',
+                                                *transform_bounds('EPSG:4326', 'EPSG:3857', *aoi_geom.bounds))
+    if os.path.exists(image_fp):
+        # marks it as recently used
+        os.utime(image_fp)
+    else:
+        geoms = gpd.GeoSeries(geoms, crs='EPSG:4326')
+        geoms = geoms[~(geoms.isna() | geoms.is_empty)]
+        points = geoms.to_crs(crs).centroid
+        xy = np.column_stack([points.x.values, points.y.values])
+        bounds = transform_bounds('EPSG:4326', crs, *aoi_geom.bounds)
+        density, src_transform = kde_surface(xy, bounds, cell_size, bandwidth)
+        # per km²
+        density = (density * 1e6).astype(np.float32)
+
+        dst_bounds = transform_bounds('EPSG:4326', 'EPSG:3857', *aoi_geom.bounds)
+        dst_width = max(int(math.ceil((dst_bounds[2] - dst_bounds[0]) / cell_size)), 1)
+        dst_height = max(int(math.ceil((dst_bounds[3] - dst_bounds[1]) / cell_size)), 1)
+        data = np.zeros((dst_height, dst_width), dtype=np.float32)
+        reproject(density, data, src_transform=src_transform, src_crs=crs,
+                  dst_transform=rasterio.transform.from_bounds(*dst_bounds, dst_width, dst_height),
+                  dst_crs='EPSG:3857', resampling=Resampling.bilinear)
+        data[data < data.max() * KDE_ALPHA_CUTOFF] = 0
+        save_heatmap(colorize(data, 0, data.max()), image_fp)
+    return ImageOverlay(
+        name=layer_name,
+        image=image_fp,
+        bounds=[[south, west], [north, east]],
+        opacity=0.6
+    )
+
+def lonlat_to_tile(lon, lat, zoom):
+    """
+    the XYZ tile containing (lon, lat) at `zoom`
+    """
+    n = 2 ** zoom
+    lat = max(min(lat, 85.0511), -85.0511)
+    x = int((lon + 180) / 360 * n)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+def tile_bounds(x, y, zoom):
+    """
+    (minx, miny, maxx, maxy) of an XYZ tile in web mercator meters
+    """
+    size = 2 * WEB_MERCATOR_ORIGIN / 2 ** zoom
+    minx = -WEB_MERCATOR_ORIGIN + x * size
+    maxy = WEB_MERCATOR_ORIGIN - y * size
+    return minx, maxy - size, minx + size, maxy
+
+def iter_tile_counts(geoms, tree, aoi_bounds, zoom):
+    """
+    yields (x, y, counts) for every tile at `zoom` over `aoi_bounds` (in
+    degrees) that has a geometry in it, only burning the geometries the
+    tile's envelope hits
+    """
+    minx, miny, maxx, maxy = aoi_bounds
+    min_x, min_y = lonlat_to_tile(minx, maxy, zoom)
+    max_x, max_y = lonlat_to_tile(maxx, miny, zoom)
+    for x in range(min_x, max_x + 1):
+        for y in range(min_y, max_y + 1):
+            bounds = tile_bounds(x, y, zoom)
+            hits = tree.query(shapely.box(*bounds))
+            if len(hits) == 0:
+                continue
+            trans = rasterio.transform.from_bounds(*bounds, TILE_SIZE, TILE_SIZE)
+            counts = burn_density(geoms[hits], trans, (TILE_SIZE, TILE_SIZE))
+            if counts.any():
+                yield x, y, counts
+
+def vector_to_heatmap_tiles(geoms, layer_name, aoi_geom, tile_dir, min_zoom=5, max_zoom=12, tile_url=None):
+    """
+    writes the heatmap as an XYZ pyramid of 256 px uint8 PNG tiles under
+    <tile_dir>/<z>/<x>/<y>.png instead of one image, so the map only fetches
+    the visible tiles. every zoom level is burned at its own resolution and
+    colored against its own maximum count, empty tiles are not written
+    input:  geoms       list        shapely geometries in EPSG:4326
+            aoi_geom                geometry in EPSG:4326 bounding the tiles
+            tile_url    str         where the map loads `tile_dir` from,
+                                    defaults to `tile_dir`
+    output: a folium TileLayer for the pyramid
+    the tiles are only rendered again when the inputs recorded in
+    <tile_dir>/heatmap.key change, and the old zoom levels are removed first
+    """
+    tile_url = (tile_url or tile_dir).rstrip('/')
+    layer = TileLayer(
+        tiles=tile_url + '/{z}/{x}/{y}.png',
+        attr=layer_name,
+        name=layer_name,
+        overlay=True,
+        opacity=0.6,
+        min_zoom=min_zoom,
+        max_native_zoom=max_zoom
+    )
+    geoms = list(geoms)
+    key = heatmap_key(geoms, aoi_geom.bounds, min_zoom, max_zoom, TILE_SIZE, 'viridis')
+    key_fp = os.path.join(tile_dir, TILES_KEY_FILENAME)
+    if os.path.exists(key_fp):
+        with open(key_fp) as f:
+            if f.read() == key:
+                return layer
+        os.remove(key_fp)
+    if os.path.isdir(tile_dir):
+        for name in os.listdir(tile_dir):
+            if name.isdigit():
+                shutil.rmtree(os.path.join(tile_dir, name))
+
+    geoms = np.asarray(gpd.GeoSeries(geoms, crs='EPSG:4326').to_crs('EPSG:3857'))
+    geoms = geoms[~(shapely.is_missing(geoms) | shapely.is_empty(geoms))]
+    tree = shapely.STRtree(geoms)
+    os.makedirs(tile_dir, exist_ok=True)
+    for zoom in range(min_zoom, max_zoom + 1):
+        # colors are scaled per zoom: every tile is burned once and its
+        # counts spilled to disk until the zoom's maximum is known, so no
+        # more than one tile is held in memory
+        with tempfile.TemporaryDirectory(dir=tile_dir) as counts_dir:
+            vmax = 0
+            spilled = []
+            for x, y, counts in iter_tile_counts(geoms, tree, aoi_geom.bounds, zoom):
+                vmax = max(vmax, counts.max())
+                np.save(os.path.join(counts_dir, f"{x}_{y}.npy"), counts.astype(np.min_scalar_type(counts.max())))
+                spilled.append((x, y))
+            for x, y in spilled:
+                counts = np.load(os.path.join(counts_dir, f"{x}_{y}.npy"))
+                os.makedirs(os.path.join(tile_dir, str(zoom), str(x)), exist_ok=True)
+                image = Image.fromarray(colorize(counts, 0, vmax), 'RGBA')
+                image.save(os.path.join(tile_dir, str(zoom), str(x), f"{y}.png"), format='PNG')
+    # written last, an interrupted run renders everything again
+    with open(key_fp, "w") as f:
+        f.write(key)
+    return layer
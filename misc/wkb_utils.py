@@ -0,0 +1,58 @@
+import hashlib
+import numpy as np
+import shapely
+
+def pack_wkb(geoms):
+    """
+    packs an array of shapely geometries into one contiguous WKB buffer
+    returns (data, offsets): geometry i is data[offsets[i]:offsets[i + 1]]
+    """
+    wkbs = shapely.to_wkb(geoms)
+    offsets = np.zeros(len(wkbs) + 1, dtype=np.int64)
+    np.cumsum([len(wkb) for wkb in wkbs], out=offsets[1:])
+    data = np.frombuffer(b''.join(wkbs), dtype=np.uint8)
+    return data, offsets
+
+def unpack_wkb(data, offsets, indices=None):
+    """
+    decodes the geometries at `indices` (all of them by default) from a
+    buffer built by `pack_wkb`, without copying the rest of the buffer
+    """
+    if indices is None:
+        indices = np.arange(len(offsets) - 1)
+    view = memoryview(data)
+    return shapely.from_wkb([view[offsets[i]:offsets[i + 1]].tobytes() for i in indices])
+
+def save_wkb(fp, geoms):
+    data, offsets = pack_wkb(geoms)
+    np.savez(fp, data=data, offsets=offsets)
+
+def load_wkb(fp):
+    with np.load(fp) as npz:
+        return unpack_wkb(npz['data'], npz['offsets'])
+
+def geometry_hash(ids, geoms, *params):
+    """
+    sha256 over feature ids, their geometries' WKB and any extra parameters,
+    used to key on-disk caches of derived geometries
+    """
+    h = hashlib.sha256()
+    for feature_id, wkb in zip(ids, shapely.to_wkb(geoms)):
+        h.update(str(feature_id).encode())
+        h.update(wkb)
+    for param in params:
+        h.update(repr(param).encode())
+    return h.hexdigest()
+
+def feature_hashes(geoms, *columns):
+    """
+    one sha256 per geometry, over its WKB and the matching value of every
+    column in `columns`, used to tell which features changed between runs
+    """
+    hashes = []
+    for i, wkb in enumerate(shapely.to_wkb(geoms)):
+        h = hashlib.sha256(wkb)
+        for column in columns:
+            h.update(repr(column[i]).encode())
+        hashes.append(h.hexdigest())
+    return hashes